@@ -0,0 +1,57 @@
+# coding=utf8
+"""
+Encoding a list endpoint's worth of datetimes and Decimals with a new 
+JSONFormatter per call and isinstance checks on each value, compared with 
+the shared encoder dispatching on exact types through the default backend, 
+then through each installed json backend.
+
+    $ python benchmarks/bench_json.py
+"""
+from datetime import datetime, date, time
+from decimal import Decimal
+from functools import partial
+import json
+import timeit
+
+from proto._compat import isiterable, isnumber
+from proto.formatters import JSON_BACKENDS, json_output_formatter
+
+class LegacyFormatter(json.JSONEncoder):
+    # `JSONFormatter.default` before the dispatch table
+    formatters = {}
+
+    def default(self, o):
+        for format_type, formatter in self.formatters.items():
+            if isinstance(o, format_type):
+                return formatter(o)
+
+        if isinstance(o, (date, datetime, time)):
+            return o.isoformat()
+        elif isinstance(o, bytes):
+            return o.decode('utf8')
+        elif isinstance(o, Decimal):
+            return float(o)
+        elif isiterable(o):
+            return list(o)
+        elif isnumber(o):
+            return str(o)
+        raise TypeError("Type not serializable")
+
+legacy_output_formatter = partial(json.dumps, cls=LegacyFormatter)
+
+rows = [dict(id=i, created=datetime(2016, 2, 29, 12, i % 60), 
+             price=Decimal('{0}.99'.format(i)), tags=set(['a', 'b']))
+        for i in range(10000)]
+
+if __name__=='__main__':
+    encoders = [('legacy', legacy_output_formatter), 
+                ('default', json_output_formatter)]
+    for name, backend in JSON_BACKENDS:
+        try:
+            encoders.append((name, backend().dumps))
+        except ImportError:
+            pass
+    for label, encode in encoders:
+        elapsed = timeit.timeit(lambda: encode(rows), number=20)
+        print('{0:<10} {1:>8.1f} ms/response'.format(label, 
+                                                   elapsed / 20 * 1000))
@@ -0,0 +1,48 @@
+# coding=utf8
+"""
+Cache keys per second for the params part of a key, comparing the former
+recursive `make_hash` with the current single pass one.
+
+    $ python benchmarks/bench_make_hash.py
+"""
+from hashlib import sha1
+import timeit
+try:
+    from urllib.parse import parse_qs
+except ImportError:
+    from urlparse import parse_qs
+
+from proto.cache import params_snapshot, make_hash, fast_hasher
+
+QUERY_STRINGS = [
+    'page=2&per_page=50',
+    'q=red+shoes&sort=-price&brand=acme&brand=globex&size=42&page=1',
+    'fields=id,name,email&status=active&role=admin&role=owner&limit=100',
+    '&'.join('id={0}'.format(i) for i in range(50)),
+]
+
+def legacy_make_hash(o):
+    # `make_hash` as it was before hashing in a single pass
+    if isinstance(o, (set, tuple, list)):
+        return sha1(repr(tuple([legacy_make_hash(e) for e in o])
+                        ).encode('utf8')).hexdigest()
+    if not isinstance(o, dict):
+        return sha1(repr(o).encode('utf8')).hexdigest()
+    new_o = dict()
+    for k,v in o.items():
+        new_o[k] = legacy_make_hash(v)
+    return sha1(repr(tuple(frozenset(new_o.items()))).encode('utf8')
+                ).hexdigest()
+
+def run(label, func, snapshots, number=20000):
+    elapsed = timeit.timeit(
+        lambda: [func(s) for s in snapshots], number=number)
+    print('{0:<24} {1:>10.0f} keys/sec'.format(
+        label, number*len(snapshots)/elapsed))
+
+if __name__=='__main__':
+    snapshots = [params_snapshot(parse_qs(qs)) for qs in QUERY_STRINGS]
+    run('legacy make_hash', legacy_make_hash, snapshots)
+    run('make_hash (sha1)', make_hash, snapshots)
+    run('make_hash (fast_hasher)', 
+        lambda s: make_hash(s, hasher=fast_hasher), snapshots)
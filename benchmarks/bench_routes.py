@@ -0,0 +1,53 @@
+# coding=utf8
+"""
+Time it takes to register 5k routes when the application starts, without
+a route cache, with a cold one (first start, the cache is written) and with
+a warm one (later starts).
+
+    $ python benchmarks/bench_routes.py
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from proto import Application
+
+ROUTES = 5000
+
+def make_actions_module(tmp_dir):
+    lines = []
+    for i in range(ROUTES):
+        lines.append('def action_{0}(item_id, __request__, page=1, '
+                     'per_page=20, **kwargs): pass'.format(i))
+    with open(os.path.join(tmp_dir, 'bench_actions.py'), 'w') as f:
+        f.write('\n'.join(lines))
+    sys.path.insert(0, tmp_dir)
+    import bench_actions
+    return bench_actions
+
+def start(actions, route_cache=None):
+    class Config(object):
+        ROUTE_CACHE = route_cache
+
+    began = time.time()
+    app = Application(Config)
+    for i in range(ROUTES):
+        app.add_route('/items{0}/{{item_id:int}}/{{day:date}}'.format(i),
+                      getattr(actions, 'action_{0}'.format(i)), [], [],
+                      methods=['GET', 'PUT'], version=i % 3 or None)
+    app.save_route_cache()
+    return time.time() - began
+
+if __name__=='__main__':
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        actions = make_actions_module(tmp_dir)
+        path = os.path.join(tmp_dir, 'routes.cache')
+        for label, route_cache in [('no cache', None), ('cold cache', path),
+                                   ('warm cache', path)]:
+            print('{0:<12} {1:>8.3f} sec'.format(
+                label, start(actions, route_cache)))
+    finally:
+        shutil.rmtree(tmp_dir)
@@ -0,0 +1,71 @@
+# coding=utf8
+"""
+Requests per second through `Wrapper.__call__` for a trivial action, 
+comparing the former per-request argument resolution with the precompiled 
+invocation plan. Falcon is left out to only measure the wrapper.
+
+    $ python benchmarks/bench_wrapper.py
+"""
+import timeit
+
+from proto._compat import iteritems
+from proto.wrapper import Wrapper
+
+class Request(object):
+    path = '/items/42'
+    query_string = '&'.join('p{0}={0}'.format(i) for i in range(10))
+    params = dict(('p{0}'.format(i), str(i)) for i in range(10))
+    params['page'] = '2'
+
+    def __init__(self):
+        self.context = dict(user=object())
+
+class Response(object):
+    def __init__(self):
+        self.context = {}
+        self.data = None
+
+def show_item(item_id, __user__, __request__, page=1, per_page=20):
+    return item_id
+
+def legacy_call(self, request, response, **kwargs):
+    # `Wrapper.__call__` as it was before precompiling the invocation plan,
+    # minus the cache handling
+    kwargs.pop('version', None)
+    kwargs.pop('tenant', None)
+    if self.requires_auth and not request.context.get('user', None):
+        raise Exception('User must be logged in.')
+    if self.authorization and not request.context.get('authorized', False):
+        raise Exception('Unauthorized user.')
+    params = dict()
+    for arg, value in iteritems(kwargs):
+        params[arg] = value
+    for param, value in iteritems(request.params):
+        if param in self.func_specs.kwargsdict:
+            params.setdefault(param, value)
+    if '__app__' in self.func_specs.allargs:
+        params['__app__'] = self.app
+    if '__request__' in self.func_specs.allargs:
+        params['__request__'] = request
+    if '__response__' in self.func_specs.allargs:
+        params['__response__'] = response
+    if '__data__' in self.func_specs.allargs:
+        params['__data__'] = self.input_format(request.bounded_stream.read())
+    if '__user__' in self.func_specs.allargs:
+        params['__user__'] = request.context.get('user', None)
+    if '__tenant__' in self.func_specs.allargs:
+        params['__tenant__'] = request.context.get('tenant', None)
+    response.context['result'] = result = self.func(**params)
+    response.data = self.output_format(result)
+
+def run(label, call, number=200000):
+    request = Request()
+    elapsed = timeit.timeit(
+        lambda: call(request, Response(), item_id='42', version=None), 
+        number=number)
+    print('{0:<16} {1:>10.0f} requests/sec'.format(label, number/elapsed))
+
+if __name__=='__main__':
+    wrapper = Wrapper(None, show_item, [], [])
+    run('legacy', lambda *a, **kw: legacy_call(wrapper, *a, **kw))
+    run('compiled', wrapper)
@@ -1,11 +1,17 @@
 # coding=utf8
 from collections import namedtuple
+from datetime import datetime
+from multiprocessing.pool import ThreadPool
+from threading import Lock
+import time
 
 import falcon
 
 from ._compat import iteritems
+from .cache import accepts_encoding, coded_etag, decompress_body
+from .formatters import use_json_backend
 from .wrapper import Wrapper, VersionMapper
-from .routing import Router
+from .routing import Router, RouteCache
 
 class Application(object):
         
@@ -14,7 +20,18 @@ class Application(object):
         self.url_base = self.config.get('URL_BASE', '')
         self.default_multitenancy = default_multitenancy
         self.router = Router()
+        # compiled routes kept across restarts, see RouteCache
+        self.route_cache = None
+        if self.config.get('ROUTE_CACHE'):
+            self.route_cache = RouteCache(self.config['ROUTE_CACHE'])
+            self.router.cached_urls.update(self.route_cache.urls)
+        if self.config.get('JSON_BACKEND'):
+            # the fastest installed library is used otherwise
+            use_json_backend(self.config['JSON_BACKEND'])
         self.middleware = []
+        # keys of the responses being refreshed in the background
+        self.revalidations = set()
+        self.revalidations_lock = Lock()
 
     def _load_config(self, config):
         rv = {}
@@ -26,18 +43,39 @@ class Application(object):
     def add_route(self, url, action_func, input_formatters, output_formatters,
                   methods=None, version=None, *args, **kwargs):
         kwargs.setdefault('multitenant', self.default_multitenancy)
+        kwargs.setdefault('max_body_size', self.config.get('MAX_BODY_SIZE'))
+        argspec = None
+        if self.route_cache is not None:
+            argspec = self.route_cache.get_argspec(action_func)
         action = Wrapper(self, action_func, input_formatters, 
-                         output_formatters, **kwargs)
+                         output_formatters, argspec=argspec, **kwargs)
+        if self.route_cache is not None and argspec is None:
+            self.route_cache.set_argspec(action_func, 
+                                         action.func_specs.argspec)
         self.router.add_route(url, action, methods=methods, version=version)
 
+    def add_converter(self, name, converter):
+        # makes `converter` available to urls as `{var:name}`
+        self.router.add_converter(name, converter)
+
+    def save_route_cache(self):
+        if self.route_cache is not None:
+            self.route_cache.set_urls(self.router.parsed_urls)
+            self.route_cache.dump()
+
     def serve(self):
+        self.save_route_cache()
         self.wsgi_app = self.api = falcon.API(middleware=self.middleware)
 
         for url, route  in iteritems(self.router.routes):
             resource = {}
             for method, versioned_routes in iteritems(route.actions):
                 method_handler_name = 'on_{0}'.format(method.lower())
-                resource[method_handler_name] = VersionMapper(versioned_routes)
+                resource[method_handler_name] = VersionMapper(
+                    versioned_routes, 
+                    version_header=self.config.get('VERSION_HEADER'),
+                    version_param=self.config.get('VERSION_PARAM'),
+                    media_type_pattern=self.config.get('VERSION_MEDIA_TYPE'))
 
             # a Resource class that falcon can talk to in the form of a 
             # namedtuple.
@@ -52,15 +90,25 @@ class Application(object):
 
         return self.wsgi_app
 
-    def action_to_url(self, action, method='GET', version=None, hint=None, 
-                      **params):
-        template = self.router.action_to_url(
-            action, method=method, version=version, hint=hint, **params)
+    def url_builder(self, action, method='GET', version=None, hint=None):
         if version:
-            rv = self.url_base + '/v{0}'.format(version) + template
+            prefix = self.url_base + '/v{0}'.format(version)
         else:
-            rv = self.url_base + template 
-        return rv.format(**params)
+            prefix = self.url_base
+        return self.router.url_builder(action, method=method, version=version,
+                                       hint=hint, prefix=prefix)
+
+    def action_to_url(self, action, method='GET', version=None, hint=None, 
+                      **params):
+        return self.url_builder(
+            action, method=method, version=version, hint=hint)(**params)
+
+    def action_to_urls(self, action, params_list, method='GET', version=None,
+                       hint=None):
+        # e.g. the links to each item of a collection
+        build = self.url_builder(
+            action, method=method, version=version, hint=hint)
+        return [build(**params) for params in params_list]
 
     @property
     def cache(self):
@@ -73,10 +121,31 @@ class Application(object):
     def cache(self, cache):
         self._cache = cache
 
-
-    def populate_from_cache(self, request, response, role=None):
+    @property
+    def background(self):
+        # a pool of threads for work done outside of the request cycle,
+        # created on first use so that it's never shared across forks
+        try:
+            return self._background
+        except AttributeError:
+            self._background = ThreadPool(
+                self.config.get('BACKGROUND_THREADS', 4))
+            return self._background
+
+    def populate_from_cache(self, request, response, role=None, 
+                            fresh_ttl=None, stale_ttl=None, beta=None,
+                            variant=None):
+        """
+        With a `fresh_ttl`, entries older than that many seconds are still
+        served for another `stale_ttl` seconds, but flagged with 
+        `response.context['stale']` so that they get refreshed. Past that
+        they're ignored. With a `beta` as well, fresh entries may be ignored 
+        shortly before they expire, see `ResponseCache.load_response()`.
+        """
         key_parts = dict(
-            path=request.path, params=request.params, role=role)
+            path=request.path, params=request.params, role=role,
+            query_string=request.query_string, ttl=fresh_ttl, beta=beta,
+            variant=variant)
         cached_resource = self.cache.load_response(**key_parts)
         if not cached_resource:
             # skip
@@ -85,19 +154,32 @@ class Application(object):
         cached_data = cached_resource.get('data')
         etag = request.if_none_match
         timestamp = request.if_modified_since
+        try:
+            # stored as seconds since epoch, in UTC
+            stored_at = float(cached_resource['timestamp'])
+            cached_timestamp = datetime.utcfromtimestamp(stored_at)
+        except (KeyError, TypeError, ValueError):
+            stored_at = cached_timestamp = None
+
+        if fresh_ttl is not None and stored_at is not None:
+            age = time.time() - stored_at
+            if age>fresh_ttl + (stale_ttl or 0):
+                return False
+            response.context['stale'] = age>fresh_ttl
+
+        encoding = cached_resource.get('encoding')
+        send_encoded = encoding and accepts_encoding(
+            request.get_header('Accept-Encoding'), encoding)
+        cached_etag = cached_resource.get('etag')
+        if cached_etag and send_encoded:
+            cached_etag = coded_etag(cached_etag, encoding)
 
         # if client_etag matches cache_etag return not modified
         if etag:
-            cached_etag = cached_resource.get('etag')
             if cached_etag and etag==cached_etag:
                 response.status = falcon.HTTP_304
         # if not deactivated and cached_etag:
         elif timestamp: 
-            try:
-                cached_timestamp = datetime.fromtimestamp(
-                    float(cached_resource['timestamp']))
-            except:
-                cached_timestamp = None
             if cached_timestamp and timestamp>=cached_timestamp:
                 response.status = falcon.HTTP_304
 
@@ -106,12 +188,21 @@ class Application(object):
 
         # if etag is in cache, but client's etag is stale or empty,
         # serve back data from cache and refresh etag.
+        if encoding:
+            # stored compressed, as is to the clients accepting it
+            response.append_header('Vary', 'Accept-Encoding')
+            if send_encoded:
+                response.set_header('Content-Encoding', encoding)
+            else:
+                cached_data = decompress_body(cached_data, encoding)
+        if cached_resource.get('content_type'):
+            response.content_type = cached_resource['content_type']
         response.data = cached_data
         response.status = falcon.HTTP_200
-        if cached_resource.get('etag'):
-            response.etag = cached_resource['etag']
-        elif cached_resource.get('timestamp'):
-            response.last_modified = cached_resource['timestamp']
+        if cached_etag:
+            response.etag = cached_etag
+        elif cached_timestamp:
+            response.last_modified = cached_timestamp
         return True
 
     def __call__(self, environ, start_response):
@@ -1,9 +1,36 @@
 # coding=utf8
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime, date, time as dtime, timedelta
+from decimal import Decimal
 from hashlib import sha1
+from threading import Lock, Thread, Event
+import calendar
+import copy
+import json
+import math
+import random
+import struct
 import time
+import zlib
 import redis
-
-from proto._compat import isiterable
+from falcon.util import http_date_to_dt
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import lz4.frame as lz4
+except ImportError:
+    lz4 = None
+try:
+    # a non-cryptographic 128 bits hash, when available
+    from xxhash import xxh3_128 as fast_hasher
+except ImportError:
+    from hashlib import md5 as fast_hasher
+
+from proto._compat import (isiterable, string_types, text_type, to_bytes, 
+                           to_native)
 
 def params_snapshot(o):
     """
@@ -34,68 +61,467 @@ def params_snapshot(o):
 
     return [(k, get_value(ordered_dict, k)) for k in sorted(ordered_dict)]
 
-def make_hash(o):
-    # hashing sets, tuples and lists
+def make_hash(o, hasher=sha1):
+    """
+    Hashes `o` in a single pass: a canonical encoding of the whole structure
+    is built first, then fed at once to a single `hasher` (any hashlib-style
+    constructor, see `fast_hasher`). Dicts hash the same regardless of their
+    ordering, other containers are taken in iteration order.
+    """
+    parts = []
+    _encode(o, parts)
+    return hasher(''.join(parts).encode('utf8')).hexdigest()
+
+def _encode(o, parts):
+    # `repr()` escapes control characters, which leaves those below free to
+    # delimit containers and values unambiguously.
     if isinstance(o, (set, tuple, list)):
-        return sha1(repr(tuple([make_hash(e) for e in o]))).hexdigest()
+        parts.append('\x01')
+        for e in o:
+            _encode(e, parts)
+        parts.append('\x02')
+    elif isinstance(o, dict):
+        parts.append('\x03')
+        for k,v in sorted(o.items(), key=lambda item: repr(item[0])):
+            _encode(k, parts)
+            _encode(v, parts)
+        parts.append('\x04')
+    else:
+        parts.append(repr(o))
+        parts.append('\x00')
+
+def sizeof(o):
+    """
+    A rough estimate, in bytes, of the memory held by a cached value. Strings
+    and bytes count for their length, containers for the sum of their items.
+    Other objects are counted as a fixed 8 bytes.
+    """
+    if hasattr(o, 'encode') or hasattr(o, 'decode'):
+        return len(o)
+    if isinstance(o, dict):
+        return sum(sizeof(k) + sizeof(v) for k,v in o.items())
+    if isiterable(o):
+        return sum(sizeof(e) for e in o)
+    return 8
+
+class LocalCache(object):
+    """
+    A bounded in-process LRU cache meant to sit in front of a remote store. 
+    Entries are evicted when either `max_entries` or `max_bytes` is exceeded,
+    least recently used first, and are considered gone once their `ttl` (in
+    seconds) has elapsed. A `ttl` of `None` keeps entries until evicted.
+
+    `generation` is bumped on every eviction. A caller filling the cache from
+    a slower store can read it beforehand and hand it back to `set()`, which
+    then drops the value if its key was evicted in the meantime, so that a
+    fill racing a delete can't resurrect the deleted entry. The generations
+    of the last `max_entries` evicted keys are remembered, fills older than
+    the ones forgotten since are dropped whatever their key.
+    """
 
-    # hashing other data types except dicts 
-    if not isinstance(o, dict):
-        return sha1(repr(o)).hexdigest()
+    def __init__(self, max_entries=512, max_bytes=64*1024*1024, ttl=60):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size = 0
+        # key -> (expires, size, value)
+        self.entries = OrderedDict()
+        self.generation = 0
+        # key -> generation it was last evicted at
+        self.evictions = OrderedDict()
+        # fills started before that generation are dropped
+        self.min_generation = 0
+        self.lock = Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                expires, size, value = self.entries.pop(key)
+            except KeyError:
+                return default
+            if expires is not None and expires<=time.time():
+                self.size -= size
+                return default
+            # re-inserting to mark the entry as most recently used
+            self.entries[key] = expires, size, value
+            return value
+
+    def set(self, key, value, ttl=None, generation=None):
+        if ttl is None:
+            ttl = self.ttl
+        size = sizeof(value)
+        if size>self.max_bytes:
+            # never going to fit, make sure we don't keep an older copy
+            self.evict(key)
+            return
+        expires = time.time() + ttl if ttl is not None else None
+        with self.lock:
+            if generation is not None and generation<max(
+                    self.min_generation, self.evictions.get(key, 0)):
+                return
+            self._pop(key)
+            self.entries[key] = expires, size, value
+            self.size += size
+            while (len(self.entries)>self.max_entries 
+                   or self.size>self.max_bytes):
+                self._pop(next(iter(self.entries)))
+
+    def evict(self, *keys):
+        with self.lock:
+            self.generation += 1
+            for key in keys:
+                self._pop(key)
+                self.evictions.pop(key, None)
+                self.evictions[key] = self.generation
+            while len(self.evictions)>self.max_entries:
+                key, self.min_generation = self.evictions.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.entries.clear()
+            self.size = 0
+            self.evictions.clear()
+            self.min_generation = self.generation
+
+    def _pop(self, key):
+        try:
+            expires, size, value = self.entries.pop(key)
+        except KeyError:
+            return
+        self.size -= size
+
+class RawCodec(object):
+    """
+    Leaves the response fields untouched and lets the redis client coerce 
+    them to strings.
+    """
+
+    def encode(self, fields):
+        return fields
+
+    def decode(self, fields):
+        return fields
+
+class MsgpackCodec(object):
+    """
+    Encodes each field of a cached response with msgpack, preserving dates, 
+    times and decimals. Values whose encoding exceeds `compress_threshold` 
+    bytes are compressed with `compression`, either 'zlib' or 'lz4'. A
+    leading byte records how each value was stored, so the threshold and the
+    compression can be changed without invalidating existing entries.
+
+    Redis clients used with this codec must not decode responses.
+    """
 
-    # hashing dicts
-    new_o = dict()
-    for k,v in o.items():
-        new_o[k] = make_hash(v)
-    return sha1(repr(tuple(frozenset(new_o.items())))).hexdigest()
+    PLAIN, ZLIB, LZ4 = b'\x00', b'\x01', b'\x02'
+    DATETIME, DATE, TIME, DECIMAL = 1, 2, 3, 4
+    EPOCH = datetime(1970, 1, 1)
+
+    def __init__(self, compress_threshold=1024, compression='zlib',
+                 compress_level=6):
+        if msgpack is None:
+            raise ImportError('MsgpackCodec requires the msgpack package.')
+        if compression=='lz4' and lz4 is None:
+            raise ImportError('lz4 compression requires the lz4 package.')
+        self.compress_threshold = compress_threshold
+        self.compression = compression
+        self.compress_level = compress_level
+
+    def encode(self, fields):
+        return dict((k, self.dumps(v)) for k,v in fields.items())
+
+    def decode(self, fields):
+        return dict((to_native(k), self.loads(v)) for k,v in fields.items())
+
+    def dumps(self, value):
+        rv = msgpack.packb(value, use_bin_type=True, default=self.default)
+        if (self.compression is None or self.compress_threshold is None 
+            or len(rv)<self.compress_threshold):
+            return self.PLAIN + rv
+        if self.compression=='lz4':
+            return self.LZ4 + lz4.compress(rv)
+        return self.ZLIB + zlib.compress(rv, self.compress_level)
+
+    def loads(self, value):
+        flag, value = value[:1], value[1:]
+        if flag==self.ZLIB:
+            value = zlib.decompress(value)
+        elif flag==self.LZ4:
+            value = lz4.decompress(value)
+        return msgpack.unpackb(value, raw=False, ext_hook=self.ext_hook)
+
+    def default(self, o):
+        if isinstance(o, datetime):
+            if o.tzinfo is not None:
+                o = o.replace(tzinfo=None) - o.utcoffset()
+            delta = o - self.EPOCH
+            microseconds = ((delta.days*86400 + delta.seconds)*1000000 
+                            + delta.microseconds)
+            return msgpack.ExtType(self.DATETIME, 
+                                   struct.pack('>q', microseconds))
+        if isinstance(o, date):
+            return msgpack.ExtType(self.DATE, struct.pack('>i', o.toordinal()))
+        if isinstance(o, dtime):
+            microseconds = ((o.hour*60 + o.minute)*60 + o.second)*1000000 
+            return msgpack.ExtType(self.TIME, struct.pack(
+                '>q', microseconds + o.microsecond))
+        if isinstance(o, Decimal):
+            return msgpack.ExtType(self.DECIMAL, str(o).encode('ascii'))
+        if isiterable(o):
+            return list(o)
+        # same as what the redis client would have stored
+        return text_type(o)
+
+    def ext_hook(self, code, data):
+        if code==self.DATETIME:
+            microseconds, = struct.unpack('>q', data)
+            return self.EPOCH + timedelta(microseconds=microseconds)
+        if code==self.DATE:
+            ordinal, = struct.unpack('>i', data)
+            return date.fromordinal(ordinal)
+        if code==self.TIME:
+            microseconds, = struct.unpack('>q', data)
+            seconds, microsecond = divmod(microseconds, 1000000)
+            minutes, second = divmod(seconds, 60)
+            hour, minute = divmod(minutes, 60)
+            return dtime(hour, minute, second, microsecond)
+        if code==self.DECIMAL:
+            return Decimal(data.decode('ascii'))
+        return msgpack.ExtType(code, data)
+
+def chunks(iterable, size):
+    # yields lists of up to `size` items from `iterable`
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk)>=size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+# content codings of response bodies, as in `Content-Encoding`
+WBITS = dict(gzip=16 + zlib.MAX_WBITS, deflate=zlib.MAX_WBITS)
+
+def compress_body(data, encoding, level=6):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, WBITS[encoding])
+    return compressor.compress(data) + compressor.flush()
+
+def decompress_body(data, encoding):
+    return zlib.decompress(data, WBITS[encoding])
+
+def coded_etag(etag, encoding):
+    # each content coding gets its own validator, e.g. abc-gzip
+    if etag.endswith('"'):
+        return '{0}-{1}"'.format(etag[:-1], encoding)
+    return '{0}-{1}'.format(etag, encoding)
+
+def accepts_encoding(accept_encoding, encoding):
+    # whether an `Accept-Encoding` header allows `encoding`
+    if not accept_encoding:
+        return False
+    for coding in accept_encoding.split(','):
+        coding, _, params = coding.partition(';')
+        if coding.strip().lower() not in (encoding, '*'):
+            continue
+        q = params.strip()
+        if q.startswith('q='):
+            try:
+                return float(q[2:]) > 0
+            except ValueError:
+                return False
+        return True
+    return False
 
 class ResponseCache(object):
 
-    def __init__(self, store):
+    def __init__(self, store, local_cache=None, codec=None, hasher=sha1,
+                 params_memo_size=1024, body_only=False, compression=None,
+                 compress_threshold=1024, compress_level=6):
         self.store = store
-
-    def make_key(self, path, params=None, role=None):
-        # returns `path` unmodified if `params` and `role` are empty 
+        # optional in-process tier consulted before hitting the store
+        self.local_cache = local_cache
+        # how response fields are turned into what's stored and back
+        self.codec = codec or RawCodec()
+        # hash function used for the params part of keys
+        self.hasher = hasher
+        # params hashes of the most recently seen raw query strings
+        self.params_memo = LocalCache(max_entries=params_memo_size, ttl=None)
+        # key -> Event set once the entry being filled by this process is
+        # stored, see `single_flight()`
+        self.flights = {}
+        self.flights_lock = Lock()
+        # only keep what's needed to serve the response, the encoded body and
+        # its headers, rather than also the action's result and params
+        self.body_only = body_only
+        # bodies of at least `compress_threshold` bytes are stored compressed
+        # with `compression`, 'gzip' or 'deflate', and sent as such to the 
+        # clients accepting it
+        self.compression = compression
+        self.compress_threshold = compress_threshold
+        self.compress_level = compress_level
+
+    def make_key(self, path, params=None, role=None, query_string=None,
+                 variant=None):
+        # returns `path` unmodified if `params`, `role` and `variant` are 
+        # empty. `variant` tells apart representations of a same response,
+        # e.g. its media type.
         key = [path]
         if role:
             key.append(role)
         if params:
-            hashed_params = make_hash(params_snapshot(params))
+            # `params` parsed from a query string hash the same every time,
+            # which spares snapshotting and hashing them on repeated requests
+            hashed_params = (self.params_memo.get(query_string) 
+                             if query_string else None)
+            if hashed_params is None:
+                hashed_params = make_hash(params_snapshot(params), 
+                                          hasher=self.hasher)
+                if query_string:
+                    self.params_memo.set(query_string, hashed_params)
             if hashed_params:
                 key.append(hashed_params)
+        if variant:
+            key.append(variant)
         return ':'.join(key)
 
     #def store_resource(self, key, resource, data_type=None):
     #    return True
 
-    def store_response(self, path, response, params=None, role=None):
-        key_parts = dict(path = path, params = params, role=role)
-        key = self.make_key(**key_parts)
+    def store_response(self, path, response, params=None, role=None,
+                       query_string=None, ttl=None, delta=None, variant=None):
+        # `delta` is the time, in seconds, it took to compute the response
+        key_parts = dict(path = path, params = params, role=role,
+                         query_string=query_string)
+        key = self.make_key(variant=variant, **key_parts)
+        data = response.data
+        encoding = ''
+        if (self.compression and data is not None 
+            and len(data)>=self.compress_threshold):
+            data = compress_body(to_bytes(data, 'utf8'), self.compression, 
+                                 self.compress_level)
+            encoding = self.compression
+            # for `CompressionMiddleware` to send rather than compress again
+            response.context['compressed'] = (encoding, data)
+        last_modified = response.last_modified
+        if isinstance(last_modified, string_types):
+            # falcon responses hand the header back
+            last_modified = http_date_to_dt(last_modified)
         response_cache = dict(
-            result=response.context.get('result'),
-            data=response.data,
+            data=data,
+            encoding=encoding,
+            content_type=getattr(response, 'content_type', None) or '',
             path=path,
             role=role or '',
             etag=response.etag,
-            #timestamp=time.mktime(response.last_modified.timetuple()),
-            timestamp=response.last_modified,
-            params=params,
-            # NOTE: try these in case we have problems with the above
-            #params=json.dumps(request.params),
-            #params=json.dumps(params_snapshot(request.params)),
+            # seconds since epoch, `last_modified` being in UTC
+            timestamp=(calendar.timegm(last_modified.utctimetuple())
+                       if last_modified else ''),
+            delta=delta if delta is not None else '',
         )
-        return self.store.set_hash(key, response_cache, data_type='response')
+        if not self.body_only:
+            response_cache.update(
+                result=response.context.get('result'),
+                params=params,
+                # NOTE: try these in case we have problems with the above
+                #params=json.dumps(request.params),
+                #params=json.dumps(params_snapshot(request.params)),
+            )
+        with self.store.pipeline() as pipe:
+            if self.local_cache is not None:
+                # only a former entry may have local copies elsewhere
+                pipe.exists(key, data_type='response')
+            pipe.set_hash(key, self.codec.encode(response_cache), 
+                          data_type='response', ttl=ttl)
+            if variant:
+                # deleting the response deletes all its representations
+                pipe.add_to_set(self.make_key(**key_parts), key, 
+                                data_type='dependents')
+        results = list(pipe.results)
+        if self.local_cache is not None:
+            # the local copy is refilled from the store on the next load, the
+            # other workers are told to drop theirs
+            self.local_cache.evict(key)
+            if results.pop(0):
+                self.store.publish_invalidation([key])
+        return results[0]
         #return self.store_resource(key, response_cache, data_type='response')
 
-    def delete_response(self, path, params=None, role=None):
+    def delete_response(self, path, params=None, role=None, max_depth=None):
         key_parts = dict(path=path, params=params, role=role)
         key = self.make_key(**key_parts)
-        self.store.delete(key, data_type='response')
-        dependents = self.find_dependents(key)
-        for d in dependents:
-            self.delete_response(d)
-            self.drop_dependencies(d)
+        purged = self.store.delete_cascade(key, max_depth=max_depth)
+        if self.local_cache is not None:
+            self.local_cache.evict(*purged)
+        # a single event for the whole cascade lets the other workers drop
+        # their local copies
+        self.store.publish_invalidation(purged)
+        return len(purged)
+
+    def listen_invalidations(self):
+        """
+        Starts a background thread evicting from the local cache the keys
+        deleted by other processes. Threads don't survive a fork, so this must
+        be called from within each worker (e.g. in gunicorn's `post_fork`).
+        """
+        if self.local_cache is None:
+            return
+        listener = InvalidationListener(self.store, self.local_cache)
+        listener.start()
+        return listener
 
+    @contextmanager
+    def single_flight(self, path, params=None, role=None, query_string=None,
+                      timeout=10, poll_interval=0.05, variant=None):
+        """
+        Lets a single caller at a time, across threads and processes, fill a
+        missing entry. The block runs with `True` for the caller that should 
+        compute and store the response. Other callers are held until that 
+        response is stored or `timeout` seconds elapse, then run the block 
+        with `False`: they should load the response from the cache and only
+        compute it themselves if it's still missing.
+
+        e.g.
+        with cache.single_flight(path, params) as leader:
+            if leader or not cache.load_response(path, params):
+                ...
+        """
+        key = self.make_key(path=path, params=params, role=role,
+                            query_string=query_string, variant=variant)
+        # threads of this process line up behind an in-process leader
+        with self.flights_lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = Event()
+        if not leader:
+            flight.wait(timeout)
+            yield False
+            return
+
+        # which in turn lines up behind the leaders of other processes
+        try:
+            lock = self.store.lock(key, timeout=timeout)
+            if lock.acquire(blocking=False):
+                try:
+                    yield True
+                finally:
+                    self.store.release(lock)
+            else:
+                self.store.wait_unlocked(key, timeout=timeout, 
+                                         poll_interval=poll_interval)
+                yield False
+        finally:
+            with self.flights_lock:
+                del self.flights[key]
+            flight.set()
 
     def register_dependencies(self, dependent_params, dependencies):
         if not (dependent_params or dependencies):
@@ -103,25 +529,77 @@ class ResponseCache(object):
         if not isiterable(dependencies, exclude_dict=True):
             dependencies = [dependencies]
         key = self.make_key(**dependent_params)
-        for params in dependencies:
-            dependency = self.make_key(**params)
-            self.store.add_to_set(dependency, key, data_type='dependents')
-            self.store.add_to_set(key, dependency, data_type='dependencies')
+        with self.store.pipeline() as pipe:
+            for params in dependencies:
+                dependency = self.make_key(**params)
+                pipe.add_to_set(dependency, key, data_type='dependents')
+                pipe.add_to_set(key, dependency, data_type='dependencies')
 
-    def drop_dependencies(self, path, params=None, role=None):
+    def drop_dependencies(self, path, params=None, role=None, count=None):
         key = self.make_key(path=path, params=params, role=role)
-        dependencies = self.store.get_data(key, data_type='dependencies')
-        for d in dependencies:
-            self.store.pop_set(d, key, data_type='dependents')
+        dependencies = self.store.iter_members(
+            key, data_type='dependencies', count=count)
+        # streaming the removals in batches so that even very large sets are
+        # never held in memory as a whole
+        for batch in chunks(dependencies, count or self.store.scan_count):
+            with self.store.pipeline() as pipe:
+                for d in batch:
+                    pipe.pop_set(d, key, data_type='dependents')
         self.store.empty_set(key, data_type='dependencies')
 
-    def find_dependents(self, path, params=None, role=None):
-        key = self.make_key(path=path, params=params, role=role)
-        return self.store.get_data(key, data_type='dependents')
+    def find_dependents(self, path, params=None, role=None, count=None):
+        # SSCAN may return a member more than once
+        return list(set(self.iter_dependents(path, params=params, role=role,
+                                             count=count)))
 
-    def load_response(self, path, params=None, role=None):
+    def iter_dependents(self, path, params=None, role=None, count=None):
         key = self.make_key(path=path, params=params, role=role)
-        return self.store.get_data(key, data_type='response')
+        return self.store.iter_members(key, data_type='dependents', 
+                                       count=count)
+
+    def load_response(self, path, params=None, role=None, query_string=None,
+                      ttl=None, beta=None, variant=None):
+        """
+        Given the `ttl` of the entry and a `beta`, the entry may be reported 
+        missing shortly before it expires (XFetch, "Optimal Probabilistic
+        Cache Stampede Prevention"). The chances grow as expiry nears and with
+        the time the response took to compute, so that a single request will
+        likely recompute it before all the others find it gone. A `beta` of 1
+        is a sensible default, higher values favor earlier recomputation.
+        """
+        key = self.make_key(path=path, params=params, role=role, 
+                            query_string=query_string, variant=variant)
+        rv = self._load_response(key)
+        if rv and beta and ttl is not None and self.expires_early(rv, ttl, beta):
+            return {}
+        return rv
+
+    def expires_early(self, cached, ttl, beta):
+        try:
+            expiry = float(cached['timestamp']) + ttl
+            delta = float(cached['delta'])
+        except (KeyError, TypeError, ValueError):
+            return False
+        now = time.time()
+        if now>=expiry:
+            # past `ttl` it's up to the caller, e.g. to serve it stale
+            return False
+        # 1 - random() is in (0, 1], keeping log() defined
+        return now - delta*beta*math.log(1 - random.random())>=expiry
+
+    def _load_response(self, key):
+        if self.local_cache is None:
+            return self.codec.decode(
+                self.store.get_data(key, data_type='response'))
+
+        rv = self.local_cache.get(key)
+        if rv is None:
+            generation = self.local_cache.generation
+            rv = self.codec.decode(
+                self.store.get_data(key, data_type='response'))
+            if rv:
+                self.local_cache.set(key, rv, generation=generation)
+        return rv
 
     def load_all_responses(self, request, role=None):
         key = self.make_key(path, role=role)
@@ -130,14 +608,104 @@ class ResponseCache(object):
             pattern, data_type='response')
 
     def get_timestamp(self):
-        dt = datetime.datetime.utcnow()
-        return time.mktime(dt.timetuple())
+        return calendar.timegm(datetime.utcnow().utctimetuple())
+
+class InvalidationListener(Thread):
+    """
+    Subscribes to the invalidation channel of a `RedisStore` and evicts from 
+    `local_cache` every key announced there. If the connection drops, events
+    may have been missed, so the local cache is emptied before resubscribing.
+    """
+
+    def __init__(self, store, local_cache, retry_delay=1):
+        super(InvalidationListener, self).__init__()
+        self.daemon = True
+        self.store = store
+        self.local_cache = local_cache
+        self.retry_delay = retry_delay
+        self.stopped = Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                self.listen()
+            except redis.ConnectionError:
+                self.local_cache.clear()
+                self.stopped.wait(self.retry_delay)
+
+    def listen(self):
+        pubsub = self.store.server.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(self.store.channel)
+        try:
+            while not self.stopped.is_set():
+                message = pubsub.get_message(timeout=1.0)
+                if message and message['type']=='message':
+                    self.local_cache.evict(*json.loads(message['data']))
+        finally:
+            pubsub.close()
+
+    def stop(self):
+        self.stopped.set()
+
+# Deletes a response along with all its dependents, breadth first, dropping
+# the dependencies of each dependent as it goes. Runs on the server so that 
+# the whole cascade is atomic and costs a single round trip.
+# ARGV: response prefix, dependents prefix, dependencies prefix, max depth, key
+# Returns the list of purged keys.
+# The keys it touches are built from the ARGV prefixes rather than declared
+# in KEYS, which only works against a single Redis node: Redis Cluster would
+# reject them as belonging to other slots.
+DELETE_CASCADE_SCRIPT = """
+local response, dependents, dependencies = ARGV[1], ARGV[2], ARGV[3]
+local max_depth = tonumber(ARGV[4])
+local visited = {[ARGV[5]] = true}
+local level = {ARGV[5]}
+local purged = {}
+local depth = 0
+while #level > 0 do
+    local next_level = {}
+    for _, key in ipairs(level) do
+        redis.call('DEL', response .. key)
+        purged[#purged + 1] = key
+        if depth < max_depth then
+            for _, d in ipairs(redis.call('SMEMBERS', dependents .. key)) do
+                if not visited[d] then
+                    visited[d] = true
+                    next_level[#next_level + 1] = d
+                end
+            end
+        end
+    end
+    for _, d in ipairs(next_level) do
+        for _, dep in ipairs(redis.call('SMEMBERS', dependencies .. d)) do
+            redis.call('SREM', dependents .. dep, d)
+        end
+        redis.call('DEL', dependencies .. d)
+    end
+    level = next_level
+    depth = depth + 1
+end
+return purged
+"""
 
 class RedisStore(object):
 
+    # how many levels of dependents a delete may cascade through
+    max_cascade_depth = 100
+    # sets up to that size are read in one go with SMEMBERS, larger ones are
+    # iterated with SSCAN, requesting `scan_count` members per page
+    small_set_size = 1000
+    scan_count = 1000
+    # maximum of keys passed to a single UNLINK
+    unlink_batch_size = 500
+    # set on the stores yielded by `pipeline()`
+    pipelined = False
+
     def __init__(self, namespace, host=None, port=None, db=None):
         self.namespace = namespace
         self.template = namespace + ":{data_type}:{key}"
+        # pub/sub channel on which deleted keys are announced
+        self.channel = namespace + ":invalidations"
 
         """
         NOTE: In the redis template above: 
@@ -159,7 +727,7 @@ class RedisStore(object):
         is being sought.
         """
 
-        self.value_types = ('value',)
+        self.value_types = ('value', 'lock')
         self.hash_types = ('hash', 'response')
         self.set_types = ('set', 'dependencies', 'dependents')
         self.default_data_type = 'value'
@@ -174,6 +742,10 @@ class RedisStore(object):
             db = 0
 
         self.server = redis.StrictRedis(host, port=port, db=db)
+        # sent with EVALSHA, the script is only loaded (SCRIPT LOAD) the 
+        # first time or if the server's script cache was flushed
+        self.delete_cascade_script = self.server.register_script(
+            DELETE_CASCADE_SCRIPT)
 
     def check_data_type(self, data_type):
         supported = (self.value_types + self.hash_types + self.set_types)
@@ -190,7 +762,9 @@ class RedisStore(object):
     def key(self, key, data_type=None):
         if not data_type:
             data_type = self.default_data_type
-        self.check_data_type(data_type)
+        # '*' only makes sense in patterns, where it matches any data type
+        if data_type!='*':
+            self.check_data_type(data_type)
         return self.template.format(key=key, data_type=data_type)
 
     def get_data(self, key, data_type=None):
@@ -204,9 +778,30 @@ class RedisStore(object):
         elif data_type in self.hash_types:
             rv = self.server.hgetall(key)
         elif data_type in self.set_types:
-            page, rv = self.server.sscan(key)
+            rv = list(self._iter_members(key))
         return rv
 
+    def iter_members(self, key, data_type=None, count=None):
+        if not data_type:
+            data_type = self.default_set_type
+        return self._iter_members(self.key(key, data_type), count=count)
+
+    def _iter_members(self, key, count=None):
+        if self.server.scard(key)<=self.small_set_size:
+            for member in self.server.smembers(key):
+                yield member
+            return
+        # redis-cli> SSCAN key cursor COUNT count
+        for member in self.server.sscan_iter(key, count=count or 
+                                             self.scan_count):
+            yield member
+
+    def get_members(self, key, data_type=None):
+        if not data_type:
+            data_type = self.default_set_type
+        key = self.key(key, data_type)
+        return self.server.smembers(key)
+
     def get_all_data_from_pattern(self, pattern, data_type=None):
         keys = self.scan_keys(pattern, data_type=data_type)
         rv = dict((k, self.server.hgetall(k)) for k in keys)
@@ -215,18 +810,28 @@ class RedisStore(object):
     def scan_keys(self, pattern, data_type=None):
         # fetch all keys that match glob-style pattern.
         rv = set()
+        for keys in self.scan_pages(pattern, data_type=data_type, count=10000):
+            rv.update(keys)
+        return rv
+
+    def scan_pages(self, pattern, data_type=None, count=None):
+        # yields the keys matching glob-style pattern, one SCAN page at a time
         cursor = 0
-        count = 10000
         match = self.key(pattern, data_type)
         while True:
             # redis-cli> SCAN cursor MATCH match COUNT count
-            cursor, keys = self.server.scan(cursor, match=match, count=count)
-            rv = rv.union(keys)
+            cursor, keys = self.server.scan(cursor, match=match, 
+                                            count=count or self.scan_count)
+            yield keys
             # if full iteration, end the loop
             if cursor==0:
                 break
-        return rv
     
+    def exists(self, key, data_type=None):
+        if not data_type:
+            data_type = self.default_data_type
+        return self.server.exists(self.key(key, data_type))
+
     def add_to_set(self, key, value, data_type=None):
         if not data_type:
             data_type = self.default_set_type
@@ -237,7 +842,7 @@ class RedisStore(object):
         if not data_type:
             data_type = self.default_set_type
         key = self.key(key, data_type)
-        while self.server.spop(key): pass
+        self.server.delete(key)
 
     def pop_set(self, key, value, data_type=None):
         if not data_type:
@@ -245,23 +850,120 @@ class RedisStore(object):
         key = self.key(key, data_type)
         self.server.srem(key, value)
 
-    def set_hash(self, key, data, data_type=None):
+    def set_hash(self, key, data, data_type=None, ttl=None):
         if not data_type:
             data_type = self.default_hash_type
         key = self.key(key, data_type)
-        # redis-cli HMSET key field value [field value...]
-        return self.server.hmset(key, data)
+        if ttl is None:
+            # redis-cli HMSET key field value [field value...]
+            return self.server.hmset(key, data)
+        if self.pipelined:
+            # queued along with the other commands, both replies end up in
+            # `results`
+            self.server.hmset(key, data)
+            return self.server.expire(key, int(ttl))
+        pipe = self.server.pipeline()
+        pipe.hmset(key, data)
+        pipe.expire(key, int(ttl))
+        return pipe.execute()[0]
+
+    def delete_all(self, pattern, data_type=None, count=None, progress=None,
+                   rate_limit=None):
+        """
+        Unlinks the keys matching `pattern` as each SCAN page comes in, so
+        that neither the client nor the server ever deal with the whole key
+        set at once. UNLINK reclaims memory in a background thread on the 
+        server, which keeps large deletes from blocking it.
 
-    def delete_all(self, pattern, data_type=None):
+        `progress` is called with the running total of unlinked keys after 
+        each page. `rate_limit` caps how many keys are unlinked per second.
+        Returns the total of unlinked keys.
+
+        No invalidation is published, the copies of unlinked responses held
+        in local caches (see `ResponseCache`) are served until they expire.
+        """
         if not data_type:
             data_type = '*'
 
-        keys = self.scan_keys(pattern=pattern, data_type=data_type)
-        for k in keys:
-            self.server.delete(key)
+        unlinked = 0
+        started = time.time()
+        for keys in self.scan_pages(pattern, data_type=data_type, count=count):
+            if not keys:
+                continue
+            with self.pipeline() as pipe:
+                for batch in chunks(keys, self.unlink_batch_size):
+                    # `unlink()` is missing from redis-py 2
+                    pipe.server.execute_command('UNLINK', *batch)
+            # keys may expire or be deleted between SCAN and UNLINK, only 
+            # the ones UNLINK actually removed are counted
+            unlinked += sum(pipe.results)
+            if progress:
+                progress(unlinked)
+            if rate_limit:
+                # pausing until the average rate falls back under the limit
+                delay = unlinked / float(rate_limit) - (time.time() - started)
+                if delay>0:
+                    time.sleep(delay)
+        return unlinked
+
+    @contextmanager
+    def pipeline(self):
+        """
+        Buffers the commands issued through the yielded store and sends them
+        in a single round trip when the block exits. Their replies are then
+        available, in order, in the store's `results` list.
+
+        e.g.
+        with store.pipeline() as pipe:
+            pipe.add_to_set('a', 'b')
+            pipe.get_members('a')
+        added, members = pipe.results
+        """
+        store = copy.copy(self)
+        store.server = self.server.pipeline(transaction=False)
+        store.pipelined = True
+        store.results = None
+        yield store
+        store.results = store.server.execute()
+
+    def delete_cascade(self, key, max_depth=None):
+        # single Redis node only, see DELETE_CASCADE_SCRIPT
+        if max_depth is None:
+            max_depth = self.max_cascade_depth
+        purged = self.delete_cascade_script(args=[
+            self.key('', 'response'),
+            self.key('', 'dependents'),
+            self.key('', 'dependencies'),
+            max_depth,
+            key,
+        ])
+        # bytes on py3, unlike the keys they're compared with
+        return [to_native(k, 'utf8') for k in purged]
+
+    def lock(self, key, timeout):
+        # a lock automatically released after `timeout` seconds
+        return self.server.lock(self.key(key, 'lock'), timeout=timeout)
+
+    def release(self, lock):
+        try:
+            lock.release()
+        except redis.exceptions.LockError:
+            # expired and possibly taken over by someone else already
+            pass
+
+    def wait_unlocked(self, key, timeout, poll_interval=0.05):
+        key = self.key(key, 'lock')
+        deadline = time.time() + timeout
+        while self.server.exists(key) and time.time()<deadline:
+            time.sleep(poll_interval)
+
+    def publish_invalidation(self, keys):
+        if keys:
+            self.server.publish(self.channel, json.dumps(list(keys)))
 
     def delete(self, key, data_type=None):
-        if not data_type:
-            data_type = '*'
-        key = self.key(key, data_type)
-        self.server.delete(key)
+        if not data_type or data_type=='*' or '*' in key:
+            # a pattern, e.g. `key` under any data type, DEL would only 
+            # delete a key named after it
+            return self.delete_all(key, data_type='*')
+        return self.server.delete(self.key(key, data_type))
@@ -1,10 +1,55 @@
 from datetime import datetime, date, time
 from decimal import Decimal
 from functools import partial
+from inspect import getmro
 
+import base64
+import codecs
 import json
+import re
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import simplejson
+except ImportError:
+    simplejson = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import cbor2
+    from datetime import timezone
+except ImportError:
+    cbor2 = None
 
-from ._compat import isiterable, isnumber
+from ._compat import isiterable, isnumber, iteritems
+
+def _isoformat(o):
+    return o.isoformat()
+
+def _decode_bytes(o):
+    try:
+        return o.decode('utf8')
+    except UnicodeDecodeError:
+        return base64.b64encode(o).decode('ascii')
+
+def _decode_nested_bytes(o):
+    # what the json module can't take on py2, where bytes are `str` that it 
+    # decodes itself rather than handing them to `default()`
+    if isinstance(o, bytes):
+        return _decode_bytes(o)
+    if isinstance(o, dict):
+        return dict((_decode_nested_bytes(k), _decode_nested_bytes(v)) 
+                    for k, v in iteritems(o))
+    if isinstance(o, (list, tuple, set, frozenset)):
+        return [_decode_nested_bytes(e) for e in o]
+    return o
+
+def _not_serializable(o):
+    raise TypeError("Type not serializable")
 
 class JSONFormatter(json.JSONEncoder):
 
@@ -13,6 +58,9 @@ class JSONFormatter(json.JSONEncoder):
     - iterables: to list
     - bytes: to unicode or base64
     - dates and datetimes: to isoformat
+
+    The conversion of a type is looked up once, the first time one of its
+    instances is met, then dispatched on the exact type.
     """
 
     @property
@@ -20,33 +68,318 @@ class JSONFormatter(json.JSONEncoder):
         rv = self.__dict__.setdefault('_formatters', {})
         return rv
 
+    @property
+    def dispatch(self):
+        # type -> conversion
+        return self.__dict__.setdefault('_dispatch', {})
+
     def add_formatter(self, format_type, formatter):
         self.formatters[format_type] = formatter
+        self.dispatch.clear()
+
+    def encode(self, o):
+        try:
+            return super(JSONFormatter, self).encode(o)
+        except UnicodeDecodeError:
+            # bytes that aren't utf8, on py2
+            return super(JSONFormatter, self).encode(_decode_nested_bytes(o))
 
     def default(self, o):
-        for format_type, formatter in self.formatters:
+        try:
+            convert = self.dispatch[o.__class__]
+        except KeyError:
+            convert = self.dispatch[o.__class__] = self.find_conversion(o)
+        return convert(o)
+
+    def find_conversion(self, o):
+        # the most specific of the added formatters first
+        for cls in getmro(o.__class__):
+            if cls in self.formatters:
+                return self.formatters[cls]
+
+        for format_type, formatter in iteritems(self.formatters):
             if isinstance(o, format_type):
-                return formatter(o)
+                return formatter
 
         if isinstance(o, (date, datetime, time)):
-            return o.isoformat()
+            return _isoformat
 
         elif isinstance(o, bytes):
-            try:
-                return o.decode('utf8')
-            except UnicodeDecodeError:
-                return base64.b64encode(o)
+            return _decode_bytes
 
         elif isinstance(o, Decimal):
-            return float(o)
+            return float
 
         elif isiterable(o):
-            return list(o)
+            return list
 
         elif isnumber(o):
-            return str(o)
+            return str
+
+        return _not_serializable
+
+# a single encoder shared by all the routes, rather than one per call
+json_encoder = JSONFormatter()
+
+class JSONBackend(object):
+    """
+    A json library, used by `json_output_formatter` and `json_input_formatter`.
+    Values the library can't encode on its own go through the conversions of
+    `encoder`, the same as with the standard library.
+    """
+    def __init__(self, name, dumps, loads):
+        self.name = name
+        self.dumps = dumps
+        self.loads = loads
+
+def stdlib_backend(encoder=json_encoder):
+    return JSONBackend('json', encoder.encode, json.loads)
+
+def orjson_backend(encoder=json_encoder):
+    if orjson is None:
+        raise ImportError('The orjson backend requires the orjson package.')
+    # dates and dataclasses are left to `encoder` rather than orjson's own 
+    # formats
+    options = (orjson.OPT_PASSTHROUGH_DATETIME | 
+               orjson.OPT_PASSTHROUGH_DATACLASS | orjson.OPT_NON_STR_KEYS)
+
+    def dumps(o):
+        try:
+            return orjson.dumps(o, default=encoder.default, 
+                                option=options).decode('utf8')
+        except TypeError:
+            # e.g. integers over 64 bits
+            return encoder.encode(o)
+
+    def loads(s):
+        try:
+            return orjson.loads(s)
+        except ValueError:
+            return json.loads(s)
+
+    return JSONBackend('orjson', dumps, loads)
+
+def simplejson_backend(encoder=json_encoder):
+    if simplejson is None:
+        raise ImportError(
+            'The simplejson backend requires the simplejson package.')
+    # options matching the standard library's behaviour
+    dumps_options = dict(default=encoder.default, use_decimal=False, 
+                         namedtuple_as_object=False, for_json=False)
+
+    def dumps(o):
+        try:
+            return simplejson.dumps(o, **dumps_options)
+        except UnicodeDecodeError:
+            # bytes that aren't utf8, to base64
+            return encoder.encode(o)
+
+    return JSONBackend('simplejson', dumps, 
+                       partial(simplejson.loads, use_decimal=False))
+
+JSON_BACKENDS = (
+    ('orjson', orjson_backend),
+    ('simplejson', simplejson_backend),
+    ('json', stdlib_backend),
+)
+
+def get_json_backend(name=None, encoder=json_encoder):
+    """ backend `name`, or the fastest one installed """
+    for backend_name, backend in JSON_BACKENDS:
+        if name is not None and name != backend_name:
+            continue
+        try:
+            return backend(encoder)
+        except ImportError:
+            if name is not None:
+                raise
+    raise ValueError("Unknown JSON backend '{0}'.".format(name))
+
+json_backend = get_json_backend()
+
+def use_json_backend(name=None):
+    global json_backend
+    json_backend = get_json_backend(name)
+
+def json_output_formatter(o):
+    return json_backend.dumps(o)
+
+def json_iter_output_formatter(result, encoder=json_encoder, chunk_size=8192):
+    """
+    `result` encoded piece by piece, in chunks of about `chunk_size` bytes, 
+    to use as an `output_stream`.
+    """
+    return _chunked((part.encode('utf8') 
+                     for part in encoder.iterencode(result)), chunk_size)
+
+def json_input_formatter(s):
+    return json_backend.loads(s)
+
+
+# binary formats, e.g. for service to service calls. Values with no native
+# encoding are converted as they are for json.
+
+def msgpack_output_formatter(o, encoder=json_encoder):
+    if msgpack is None:
+        raise ImportError('The msgpack formatter requires the msgpack package.')
+    return msgpack.packb(o, default=encoder.default, use_bin_type=True)
+
+def msgpack_input_formatter(s):
+    if msgpack is None:
+        raise ImportError('The msgpack formatter requires the msgpack package.')
+    return msgpack.unpackb(s, raw=False)
+
+def cbor_output_formatter(o, encoder=json_encoder):
+    if cbor2 is None:
+        raise ImportError('The cbor formatter requires the cbor2 package.')
+    # naive datetimes being in UTC
+    return cbor2.dumps(
+        o, timezone=timezone.utc, default=lambda cbor_encoder, value: 
+            cbor_encoder.encode(encoder.default(value)))
+
+def cbor_input_formatter(s):
+    if cbor2 is None:
+        raise ImportError('The cbor formatter requires the cbor2 package.')
+    return cbor2.loads(s)
+
+
+# streaming input: decode records as the body is read rather than all at once
+# so that bulk uploads are processed with constant memory. Reading only
+# happens when the action asks for the next record.
+
+_whitespace = re.compile(r'\s*')
+_number_chars = frozenset('0123456789.eE+-')
+
+def ndjson_input_stream(stream, chunk_size=65536):
+    """ newline delimited json, one document per line """
+    pending = []
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        lines = chunk.split(b'\n')
+        if len(lines) > 1:
+            pending.append(lines[0])
+            for line in [b''.join(pending)] + lines[1:-1]:
+                if line.strip():
+                    yield json.loads(line.decode('utf8'))
+            pending = []
+        pending.append(lines[-1])
+
+    line = b''.join(pending)
+    if line.strip():
+        yield json.loads(line.decode('utf8'))
+
+def json_array_input_stream(stream, chunk_size=65536):
+    """ the items of a top level json array, one at a time """
+    decoder = codecs.getincrementaldecoder('utf8')()
+    raw_decode = json.JSONDecoder().raw_decode
+    buf = u''
+    pos = 0
+    eof = False
+    read_size = chunk_size
+    # what comes next: '[' to open, 'first' item or ']', 'item', ',' or ']',
+    # then only whitespace to the 'end'
+    expects = '['
+
+    while True:
+        pos = _whitespace.match(buf, pos).end()
+        # values are only taken once followed by something that can't be
+        # part of them, a number cut by the end of a chunk would otherwise 
+        # be decoded partially
+        if pos < len(buf) and expects in ('first', 'item'):
+            if expects == 'first' and buf[pos] == ']':
+                expects = 'end'
+                pos += 1
+                continue
+            try:
+                item, end = raw_decode(buf, pos)
+            except ValueError:
+                if eof:
+                    raise
+                end = len(buf)
+            if eof or (end < len(buf) and buf[end] not in _number_chars):
+                yield item
+                pos = end
+                expects = ','
+                read_size = chunk_size
+                continue
+            # an incomplete item, read more of it each time
+            read_size *= 2
+
+        elif pos < len(buf):
+            c = buf[pos]
+            if expects == '[' and c == '[':
+                expects = 'first'
+            elif expects == ',' and c == ',':
+                expects = 'item'
+            elif expects == ',' and c == ']':
+                expects = 'end'
+            else:
+                raise ValueError("Unexpected '{0}' in JSON array at {1}."
+                                 .format(c, pos))
+            pos += 1
+            continue
+
+        elif eof:
+            if expects == 'end':
+                return
+            raise ValueError('Truncated JSON array.')
+
+        if pos > chunk_size:
+            buf = buf[pos:]
+            pos = 0
+
+        chunk = stream.read(read_size)
+        if chunk:
+            buf += decoder.decode(chunk)
+        else:
+            eof = True
+            buf += decoder.decode(b'', True)
+
+
+# streaming output: the body is encoded as the records are produced, a few 
+# kilobytes at a time, and sent as a chunked response. A stream's 
+# `media_type` is set as the response's Content-Type.
+
+def _encode_record(record):
+    return json_output_formatter(record).encode('utf8')
+
+def _chunked(parts, chunk_size):
+    buffered = []
+    size = 0
+    for part in parts:
+        buffered.append(part)
+        size += len(part)
+        if size >= chunk_size:
+            yield b''.join(buffered)
+            buffered = []
+            size = 0
+    if buffered:
+        yield b''.join(buffered)
+
+def json_array_output_stream(records, encode=_encode_record, 
+                             chunk_size=8192):
+    """ the records as the items of a json array """
+    def parts():
+        yield b'['
+        separator = b''
+        for record in records:
+            yield separator
+            yield encode(record)
+            separator = b','
+        yield b']'
+    return _chunked(parts(), chunk_size)
 
-        raise TypeError("Type not serializable")
+def ndjson_output_stream(records, encode=_encode_record, chunk_size=8192):
+    """ newline delimited json, one document per line """
+    def parts():
+        for record in records:
+            yield encode(record)
+            yield b'\n'
+    return _chunked(parts(), chunk_size)
 
-json_output_formatter = partial(json.dumps, cls=JSONFormatter)
-json_input_formatter = partial(json.loads)
+# the Content-Type of what each output stream sends
+json_array_output_stream.media_type = 'application/json'
+ndjson_output_stream.media_type = 'application/x-ndjson'
+json_iter_output_formatter.media_type = 'application/json'
@@ -1,8 +1,11 @@
 # coding=utf8
 import base64
+import zlib
 
 import falcon
 
+from ._compat import to_bytes
+from .cache import WBITS, accepts_encoding, coded_etag, compress_body
 from .globals import local
 from .local import release_local
 
@@ -102,6 +105,76 @@ class GlobalsMiddleWare(BaseMiddleware):
         release_local(local)
 
 
+def compress_stream(chunks, encoding, level=6):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, WBITS[encoding])
+    for chunk in chunks:
+        # flushed on each chunk for the client to get it as soon as it's out
+        yield (compressor.compress(to_bytes(chunk, 'utf8')) 
+               + compressor.flush(zlib.Z_SYNC_FLUSH))
+    yield compressor.flush()
+
+class CompressionMiddleware(BaseMiddleware):
+    """
+    Compresses bodies of at least `min_size` bytes, and streamed bodies, with
+    the first of `encodings` accepted by the client. Bodies compressed by 
+    `ResponseCache` (see its `compression`) when stored are reused rather 
+    than compressed again, and its compressed hits are sent as they are.
+    """
+
+    def __init__(self, min_size=1024, level=6, encodings=('gzip', 'deflate')):
+        self.min_size = min_size
+        self.level = level
+        self.encodings = encodings
+
+    def process_response(self, request, response, resource, req_succeeded):
+        if response.get_header('Content-Encoding'):
+            # e.g. served from the cache as stored
+            return
+        if response.status in (falcon.HTTP_204, falcon.HTTP_304):
+            return
+
+        data = response.data
+        body = None
+        if data is None and response.stream is None:
+            # set as text, which falcon sends rather than `data`
+            body = getattr(response, 'body', None)
+            if body is None:
+                return
+            data = to_bytes(body, 'utf8')
+        if data is not None and len(data)<self.min_size:
+            return
+
+        vary = response.get_header('Vary') or ''
+        if 'accept-encoding' not in vary.lower():
+            response.append_header('Vary', 'Accept-Encoding')
+
+        accept_encoding = request.get_header('Accept-Encoding')
+        for encoding in self.encodings:
+            if accepts_encoding(accept_encoding, encoding):
+                break
+        else:
+            return
+
+        if data is None:
+            stream = response.stream
+            if hasattr(stream, 'read'):
+                stream = iter(lambda: stream.read(65536), b'')
+            response.stream = compress_stream(stream, encoding, self.level)
+        else:
+            compressed = response.context.get('compressed')
+            if compressed and compressed[0]==encoding:
+                response.data = compressed[1]
+            else:
+                response.data = compress_body(to_bytes(data, 'utf8'), 
+                                              encoding, self.level)
+            if body is not None:
+                response.body = None
+        response.set_header('Content-Encoding', encoding)
+        etag = response.get_header('ETag')
+        if etag:
+            response.set_header('ETag', coded_etag(etag, encoding))
+
+
 class TenantMiddleware(BaseMiddleware):
     def __init__(self, application, get_tenant_func):
         self.application = application
@@ -1,12 +1,45 @@
+import os
 import re
+import sys
+from datetime import datetime
+from uuid import UUID
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+try:
+    from urllib.parse import quote
+except ImportError:
+    from urllib import quote
 
 import falcon
 from falcon.routing import create_http_method_map, compile_uri_template
 
-from ._compat import isiterable, isnumber
+from ._compat import isiterable, isnumber, iteritems, text_type, to_bytes
 
 class RoutingError(Exception): pass
 
+def to_date(value):
+    return datetime.strptime(value, '%Y-%m-%d').date()
+
+_slug_pattern = re.compile(r'^[a-z0-9]+(?:-[a-z0-9]+)*$')
+
+def to_slug(value):
+    if not _slug_pattern.match(value):
+        raise ValueError("Invalid slug: '{0}'.".format(value))
+    return value
+
+# converters available to all routers, by the name used in urls, 
+# e.g. `/users/{user_id:int}`. They raise `ValueError` on invalid values.
+CONVERTERS = {
+    'int': int,
+    'float': float,
+    'str': text_type,
+    'uuid': UUID,
+    'date': to_date,
+    'slug': to_slug,
+}
+
 class Route(object):
 
     def __init__(self, url, action_func=None, methods=None, version=None, 
@@ -59,49 +92,102 @@ class Route(object):
             pass
 
 
+class UrlBuilder(object):
+    """
+    Builds urls from a template such as `/items/{item_id}`, split once into
+    its literal and variable parts. Values are percent-encoded.
+    """
+    _variable_pattern = re.compile(r"{([^}]+)}")
+
+    def __init__(self, template, prefix=''):
+        self.template = prefix + template
+        # alternating literals and variable names, starting with a literal
+        self.parts = parts = self._variable_pattern.split(self.template)
+        self.literals = tuple(parts[::2])
+        self.variables = tuple(parts[1::2])
+
+    def __call__(self, **params):
+        rv = [self.literals[0]]
+        for variable, literal in zip(self.variables, self.literals[1:]):
+            rv.append(quote(to_bytes(text_type(params[variable]), 'utf8'), 
+                            safe=''))
+            rv.append(literal)
+        return ''.join(rv)
+
 class Router(object):
-    _converter_pattern = r"{(?P<var>[^}]+?):(?P<converter>.+?)}"
+    _converter_pattern = re.compile(r"{(?P<var>[^}]+?):(?P<converter>.+?)}")
     
     @property
     def routes(self):
         return self.__dict__.setdefault('_routes', {})
 
+    @property
+    def converters(self):
+        return self.__dict__.setdefault('_converters', dict(CONVERTERS))
+
+    def add_converter(self, name, converter):
+        self.converters[name] = converter
+
     @property
     def reverse_routes(self):
         return self.__dict__.setdefault('_reverse_routes', {})
 
+    @property
+    def parsed_urls(self):
+        # url -> (falcon url template, {variable: converter name})
+        return self.__dict__.setdefault('_parsed_urls', {})
+
+    @property
+    def cached_urls(self):
+        # parsed urls loaded from a RouteCache, moved to `parsed_urls` 
+        # once a route uses them again
+        return self.__dict__.setdefault('_cached_urls', {})
+
+    def parse_url(self, url):
+        try:
+            return self.parsed_urls[url]
+        except KeyError:
+            pass
+
+        if url in self.cached_urls:
+            rv = self.parsed_urls[url] = self.cached_urls.pop(url)
+            return rv
+
+        converter_names = dict(
+            (match.group('var'), match.group('converter')) 
+            for match in self._converter_pattern.finditer(url))
+        rv = self.parsed_urls[url] = (self._falcon_url_template(url), 
+                                      converter_names)
+        return rv
+
     def _get_converters(self, url):
-        converter_pattern = re.compile(self._converter_pattern)
         rv = {}
 
-        for match in converter_pattern.finditer(url):
-            converter = match.group('converter')
-            var = match.group('var')
+        for var, converter in iteritems(self.parse_url(url)[1]):
             try:
-                rv[var] = eval(converter)
-            except NameError:
-                __import__(converter)
-                rv[var] = eval(converter)
+                rv[var] = self.converters[converter]
+            except KeyError:
+                raise RoutingError("Unknown converter '{0}' in url '{1}'."
+                                   .format(converter, url))
 
         return rv
 
     def _falcon_url_template(self, url):
-        converter_pattern = re.compile(self._converter_pattern)
         replace_pattern = "{\g<var>}"
 
-        return converter_pattern.sub(replace_pattern, url)
+        return self._converter_pattern.sub(replace_pattern, url)
 
     def add_route(self, url, action_func, methods=None, version=None):
 
         converters = self._get_converters(url)
-        url = self._falcon_url_template(url)
+        url = self.parse_url(url)[0]
 
         route = self.routes.setdefault(url, Route(url))
         route.add_action(action_func, methods=methods, version=version,
                          converters=converters)
 
         if methods is None:
-            methods = []
+            methods = ['GET']
 
         for method in methods:
             full_name = route.actions[method][version]['full_name']
@@ -111,9 +197,34 @@ class Router(object):
             url_map.setdefault(version, []).append(url)
 
         
+    def table(self):
+        # one row per action, e.g. to list or check the routes of an app
+        for url, route in sorted(iteritems(self.routes)):
+            for method, versions in sorted(iteritems(route.actions)):
+                for version, action in iteritems(versions):
+                    yield dict(url=url, method=method, version=version, 
+                               action=action['full_name'],
+                               converters=sorted(action['converters'] or ()))
+
+    @property
+    def url_builders(self):
+        return self.__dict__.setdefault('_url_builders', {})
+
     # a reverse mapper to ease implementation of HATEOAS
     def action_to_url(self, func, method='GET', version=None, hint=None, 
                       **params):
+        return self.url_builder(func, method=method, version=version, 
+                                hint=hint).template
+
+    def url_builder(self, func, method='GET', version=None, hint=None,
+                    prefix=''):
+        # builders are compiled on first use, then looked up by their key
+        key = (func, method, version, hint, prefix)
+        try:
+            return self.url_builders[key]
+        except KeyError:
+            pass
+
         if hasattr(func, 'func_specs'):
             func_name = '.'.join([func.func_specs.module, 
                                   func.func_specs.name])
@@ -136,11 +247,99 @@ class Router(object):
         else:
             template = templates[0]
 
-        return template
-        
-        if version:
-            rv = self.app.url_base + '/v{0}'.format(version) + template
-        else:
-            rv = self.app.url_base + template 
-        return rv.format(**params)
+        rv = self.url_builders[key] = UrlBuilder(template, prefix=prefix)
+        return rv
+
+
+class RouteCache(object):
+    """
+    Keeps in a file what routing works out for each route, the parsed urls 
+    and the argument specs of the actions, so that the next start of the 
+    application can skip it. An action's argspec is only reused as long as 
+    the file of its module hasn't been modified since it was cached.
+    """
+    format_version = 1
+
+    def __init__(self, path):
+        self.path = path
+        self.urls = {}
+        self.argspecs = {}
+        # module name -> mtime of its file when its argspecs were cached
+        self.mtimes = {}
+        self.current_mtimes = {}
+        self.dirty = False
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path, 'rb') as f:
+                data = pickle.load(f)
+        except Exception:
+            # missing or unreadable, it'll be rebuilt
+            return
+
+        if data.get('format_version') != self.format_version:
+            return
+
+        self.urls = data['urls']
+        self.argspecs = data['argspecs']
+        self.mtimes = data['mtimes']
+
+    def dump(self):
+        if not self.dirty:
+            return
+
+        data = dict(format_version=self.format_version, urls=self.urls, 
+                    argspecs=self.argspecs, mtimes=self.mtimes)
+        tmp_path = '{0}.{1}.tmp'.format(self.path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
+        # other workers may be reading it
+        os.rename(tmp_path, self.path)
+        self.dirty = False
+
+    def module_mtime(self, module):
+        try:
+            return self.current_mtimes[module]
+        except KeyError:
+            pass
+
+        try:
+            rv = os.path.getmtime(sys.modules[module].__file__)
+        except (KeyError, AttributeError, TypeError, OSError):
+            rv = None
+        self.current_mtimes[module] = rv
+        return rv
+
+    def _key(self, func):
+        try:
+            return '{0}:{1}'.format(func.__name__, func.__code__.co_firstlineno)
+        except AttributeError:
+            pass
 
+    def get_argspec(self, func):
+        key = self._key(func)
+        module = func.__module__
+        mtime = self.module_mtime(module)
+        if key is None or mtime is None:
+            return
+        if self.mtimes.get(module) == mtime:
+            return self.argspecs.get(module, {}).get(key)
+
+    def set_argspec(self, func, argspec):
+        key = self._key(func)
+        module = func.__module__
+        mtime = self.module_mtime(module)
+        if key is None or mtime is None:
+            return
+        if self.mtimes.get(module) != mtime:
+            # the module changed, its former argspecs are dropped
+            self.argspecs[module] = {}
+            self.mtimes[module] = mtime
+        self.argspecs.setdefault(module, {})[key] = argspec
+        self.dirty = True
+
+    def set_urls(self, urls):
+        if urls != self.urls:
+            self.urls = dict(urls)
+            self.dirty = True
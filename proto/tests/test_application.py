@@ -1,4 +1,12 @@
+import time
 import testtools
+from datetime import datetime, timedelta
+
+import falcon
+from falcon import testing as falcon_testing
+
+from proto import Application
+from proto.cache import MsgpackCodec, RedisStore, ResponseCache, msgpack
 
 class ApplicationTest(testtools.TestCase):
 
@@ -14,3 +22,68 @@ class ApplicationTest(testtools.TestCase):
                 )
         cache = MockCache()
         wrapper.cache = cache
+
+
+class PopulateFromCacheTest(testtools.TestCase):
+    def setUp(self):
+        super(PopulateFromCacheTest, self).setUp()
+        class Config(object): pass
+        self.app = Application(Config)
+        self.store = RedisStore(namespace='test', host=None, port=None, db=0)
+        self.app.cache = ResponseCache(self.store)
+        self.addCleanup(self.store.server.flushdb)
+
+    def store_response(self, age):
+        request = falcon.Request(falcon_testing.create_environ(
+            path='/api/items', query_string='a=1'))
+        response = falcon.Response()
+        response.data = 'cached'
+        response.last_modified = datetime.utcnow() - timedelta(seconds=age)
+        self.app.cache.store_response(
+            request.path, response, params=request.params,
+            query_string=request.query_string, delta=1)
+        return request
+
+    def test_stale_with_early_expiration(self):
+        # stale entries are served, early expiration only applies to fresh
+        # ones
+        request = self.store_response(age=15)
+        response = falcon.Response()
+        self.assertTrue(self.app.populate_from_cache(
+            request, response, fresh_ttl=10, stale_ttl=50, beta=1))
+        self.assertTrue(response.context['stale'])
+        self.assertEqual(response.data, 'cached')
+
+        request = self.store_response(age=1)
+        response = falcon.Response()
+        self.assertTrue(self.app.populate_from_cache(
+            request, response, fresh_ttl=600, stale_ttl=50, beta=1))
+        self.assertFalse(response.context['stale'])
+
+        # past both
+        request = self.store_response(age=100)
+        self.assertFalse(self.app.populate_from_cache(
+            request, falcon.Response(), fresh_ttl=10, stale_ttl=50, beta=1))
+
+    def test_compressed_etags(self):
+        if msgpack is None:
+            self.skipTest('msgpack is not installed')
+        self.app.cache = ResponseCache(
+            self.store, codec=MsgpackCodec(), body_only=True, 
+            compression='gzip', compress_threshold=10)
+        response = falcon.Response()
+        response.data = b'{"a": 1}' * 10
+        response.etag = 'abc'
+        self.app.cache.store_response('/api/items', response)
+
+        def load(accept_encoding):
+            request = falcon.Request(falcon_testing.create_environ(
+                path='/api/items', 
+                headers={'Accept-Encoding': accept_encoding}))
+            response = falcon.Response()
+            self.app.populate_from_cache(request, response)
+            return response.get_header('ETag').strip('"')
+
+        # each content coding gets its own validator
+        self.assertEqual(load('gzip'), 'abc-gzip')
+        self.assertEqual(load('identity'), 'abc')
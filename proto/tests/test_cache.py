@@ -1,15 +1,141 @@
+import calendar
+import json
+import time
+import threading
 import testtools
 from collections import namedtuple
 from datetime import datetime
+from decimal import Decimal
+from uuid import uuid4
+
+import falcon
 
 from . import rndstr
+from proto._compat import to_native
 from proto.cache import (
     params_snapshot, 
     make_hash,
+    fast_hasher,
     RedisStore,
     ResponseCache,
+    LocalCache,
+    MsgpackCodec,
+    msgpack,
+    accepts_encoding,
+    compress_body,
+    decompress_body,
 )
 
+class LocalCacheTest(testtools.TestCase):
+
+    def test_get_set(self):
+        cache = LocalCache()
+        key, value = rndstr(), dict(data=rndstr())
+        self.assertIsNone(cache.get(key))
+        cache.set(key, value)
+        self.assertEqual(cache.get(key), value)
+        cache.evict(key)
+        self.assertIsNone(cache.get(key))
+
+    def test_evicts_least_recently_used(self):
+        cache = LocalCache(max_entries=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        # touching `a` makes `b` the least recently used entry
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('c'), 3)
+
+    def test_evicts_on_size(self):
+        cache = LocalCache(max_bytes=10)
+        cache.set('a', 'x'*6)
+        cache.set('b', 'x'*6)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.size, 6)
+        # values larger than the whole cache are not kept
+        cache.set('c', 'x'*11)
+        self.assertIsNone(cache.get('c'))
+
+    def test_ttl(self):
+        cache = LocalCache(ttl=60)
+        cache.set('a', 1, ttl=0.01)
+        cache.set('b', 2)
+        time.sleep(0.02)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.get('b'), 2)
+
+    def test_stale_generation_is_not_stored(self):
+        cache = LocalCache()
+        generation = cache.generation
+        cache.evict('a')
+        cache.set('a', 1, generation=generation)
+        self.assertIsNone(cache.get('a'))
+        # other keys are still filled
+        cache.set('b', 2, generation=generation)
+        self.assertEqual(cache.get('b'), 2)
+        # unless their generation was forgotten
+        cache = LocalCache(max_entries=1)
+        generation = cache.generation
+        cache.evict('a')
+        cache.evict('b')
+        cache.set('c', 3, generation=generation)
+        self.assertIsNone(cache.get('c'))
+        cache.clear()
+        cache.set('c', 3, generation=generation)
+        self.assertIsNone(cache.get('c'))
+        cache.set('c', 3, generation=cache.generation)
+        self.assertEqual(cache.get('c'), 3)
+
+class MsgpackCodecTest(testtools.TestCase):
+    def setUp(self):
+        super(MsgpackCodecTest, self).setUp()
+        if msgpack is None:
+            self.skipTest('msgpack is not installed')
+
+    def test_round_trip(self):
+        codec = MsgpackCodec()
+        now = datetime.utcnow()
+        fields = dict(
+            data=b'{"a": 1}',
+            etag=rndstr(),
+            timestamp=1500000000.5,
+            result=dict(created=now, day=now.date(), at=now.time(),
+                        price=Decimal('9.42'), tags=['a', 'b']),
+            params=None,
+        )
+        encoded = codec.encode(fields)
+        for v in encoded.values():
+            self.assertIsInstance(v, bytes)
+        self.assertEqual(codec.decode(encoded), fields)
+
+    def test_compression(self):
+        data = b'x'*2048
+        compressed = MsgpackCodec(compress_threshold=1024)
+        uncompressed = MsgpackCodec(compress_threshold=None)
+        self.assertLess(len(compressed.dumps(data)), 
+                        len(uncompressed.dumps(data)))
+        # either codec reads what the other one wrote
+        self.assertEqual(uncompressed.loads(compressed.dumps(data)), data)
+        self.assertEqual(compressed.loads(uncompressed.dumps(data)), data)
+
+class BodyCompressionTest(testtools.TestCase):
+    def test_round_trip(self):
+        data = b'{"a": 1}' * 100
+        for encoding in ('gzip', 'deflate'):
+            compressed = compress_body(data, encoding)
+            self.assertLess(len(compressed), len(data))
+            self.assertEqual(decompress_body(compressed, encoding), data)
+
+    def test_accepts_encoding(self):
+        self.assertTrue(accepts_encoding('gzip, deflate', 'gzip'))
+        self.assertTrue(accepts_encoding('deflate;q=0.5, GZIP', 'gzip'))
+        self.assertTrue(accepts_encoding('*', 'deflate'))
+        self.assertFalse(accepts_encoding('gzip;q=0, deflate', 'gzip'))
+        self.assertFalse(accepts_encoding('identity', 'gzip'))
+        self.assertFalse(accepts_encoding(None, 'gzip'))
+
 class ResponseCacheTest(testtools.TestCase):
     def setUp(self):
         super(ResponseCacheTest, self).setUp()
@@ -63,6 +189,17 @@ class ResponseCacheTest(testtools.TestCase):
         self.assertNotEqual(make_hash(params_snapshot(d1)), 
                             make_hash(params_snapshot(d3)))
 
+    def test_make_hash(self):
+        self.assertEqual(make_hash(dict(a=1, b=[1, 2])), 
+                         make_hash(dict(b=[1, 2], a=1)))
+        self.assertNotEqual(make_hash([1, 2]), make_hash([2, 1]))
+        self.assertNotEqual(make_hash([1]), make_hash(['1']))
+        # nesting must be part of the hash
+        self.assertNotEqual(make_hash([[1], 2]), make_hash([1, [2]]))
+        self.assertEqual(make_hash([1], hasher=fast_hasher),
+                         make_hash([1], hasher=fast_hasher))
+        self.assertEqual(len(make_hash([1], hasher=fast_hasher)), 32)
+
     def test_make_key(self):
         key_parts = dict(path=rndstr(), params=dict(a=rndstr(), b=rndstr()),
                          role=rndstr())
@@ -74,9 +211,78 @@ class ResponseCacheTest(testtools.TestCase):
         key2 = self.cache.make_key(key)
         self.assertEqual(key2, key)
 
+    def test_make_key_from_query_string(self):
+        path = rndstr()
+        params = dict(a=rndstr(), b=[rndstr(), rndstr()])
+        query_string = 'a={0}&b={1}&b={2}'.format(params['a'], *params['b'])
+        key = self.cache.make_key(path, params=params, 
+                                  query_string=query_string)
+        self.assertEqual(key, self.cache.make_key(path, params=params))
+        # the hash memoized for that query string is reused as is
+        key = self.cache.make_key(path, params=dict(a=1), 
+                                  query_string=query_string)
+        self.assertEqual(key, self.cache.make_key(path, params=params))
+
     def test_can_instantiate_redis_store(self):
         self.assertEqual(self.server.config_get('port')['port'], '6379')
 
+    def test_pipeline(self):
+        key = rndstr()
+        with self.store.pipeline() as pipe:
+            pipe.add_to_set(key, 'a')
+            pipe.add_to_set(key, 'b')
+            pipe.get_members(key)
+            # nothing is sent before the block exits
+            self.assertEqual(self.store.get_members(key), set())
+        self.assertEqual(set(pipe.results[-1]), set(['a', 'b']))
+        self.assertEqual(set(self.store.get_members(key)), set(['a', 'b']))
+
+    def test_delete_all(self):
+        prefix = uuid4().hex
+        for i in range(5):
+            self.store.add_to_set(prefix + str(i), 'a')
+        self.store.add_to_set(rndstr(), 'a')
+        progress = []
+        unlinked = self.store.delete_all(prefix + '*', count=2, 
+                                         progress=progress.append)
+        self.assertEqual(unlinked, 5)
+        self.assertEqual(progress[-1], 5)
+        self.assertEqual(self.store.scan_keys(prefix + '*', data_type='*'),
+                         set())
+        self.assertEqual(len(self.store.scan_keys('*', data_type='*')), 1)
+
+    def test_delete_all_counts_unlinked(self):
+        prefix = uuid4().hex
+        self.store.add_to_set(prefix + '0', 'a')
+        scan_pages = self.store.scan_pages
+        def gone_before_unlink(*args, **kwargs):
+            for keys in scan_pages(*args, **kwargs):
+                yield list(keys) + [self.store.key(prefix + 'gone', 'set')]
+        self.patch(self.store, 'scan_pages', gone_before_unlink)
+        progress = []
+        self.assertEqual(self.store.delete_all(prefix + '*', 
+                                               progress=progress.append), 1)
+        self.assertEqual(progress[-1], 1)
+
+    def test_delete(self):
+        key = uuid4().hex
+        self.store.add_to_set(key, 'a')
+        self.store.set_hash(key, dict(a=1))
+        self.assertEqual(self.store.delete(key, data_type='set'), 1)
+        self.assertFalse(self.store.get_members(key))
+        # under any data type
+        self.store.add_to_set(key, 'a')
+        self.assertEqual(self.store.delete(key), 2)
+        self.assertEqual(self.store.scan_keys(key, data_type='*'), set())
+
+    def test_delete_all_rate_limit(self):
+        prefix = uuid4().hex
+        for i in range(10):
+            self.store.add_to_set(prefix + str(i), 'a')
+        started = time.time()
+        self.store.delete_all(prefix + '*', rate_limit=100)
+        self.assertTrue(time.time() - started>=0.09)
+
     def test_store_response(self):
 
         # --- mocks
@@ -102,6 +308,50 @@ class ResponseCacheTest(testtools.TestCase):
         self.assertNotEqual(cached_resource.get('etag'), response.etag)
 
 
+    def test_body_only(self):
+        request, response = self._make_request_response()
+        response.context['result'] = dict(a=1)
+        cache = ResponseCache(self.store, body_only=True)
+        cache.store_response(request.path, response, params=request.params)
+        cached = cache.load_response(request.path, params=request.params)
+        self.assertEqual(cached['data'], response.data)
+        self.assertEqual(cached['etag'], response.etag)
+        self.assertNotIn('result', cached)
+        self.assertNotIn('params', cached)
+
+    def test_compressed_body(self):
+        if msgpack is None:
+            self.skipTest('msgpack is not installed')
+        # binary values need a codec
+        cache = ResponseCache(self.store, codec=MsgpackCodec(), body_only=True,
+                              compression='gzip', compress_threshold=10)
+        request, response = self._make_request_response()
+        cache.store_response(request.path, response, params=request.params)
+        cached = cache.load_response(request.path, params=request.params)
+        self.assertEqual(cached['encoding'], 'gzip')
+        self.assertEqual(decompress_body(cached['data'], 'gzip'), 
+                         response.data.encode('utf8'))
+        # handed to `CompressionMiddleware`
+        self.assertEqual(response.context['compressed'], 
+                         ('gzip', cached['data']))
+
+        # small bodies are left as they are
+        cache.compress_threshold = 10000
+        cache.store_response(request.path, response, params=request.params)
+        cached = cache.load_response(request.path, params=request.params)
+        self.assertEqual(cached['encoding'], '')
+        self.assertEqual(cached['data'], response.data)
+
+    def test_store_falcon_response(self):
+        # falcon returns `last_modified` as an http date
+        response = falcon.Response()
+        response.data = b'{}'
+        response.last_modified = datetime(2016, 2, 29, 12, 30)
+        self.cache.store_response('/items', response)
+        self.assertEqual(
+            float(self.cache.load_response('/items')['timestamp']), 
+            calendar.timegm(datetime(2016, 2, 29, 12, 30).utctimetuple()))
+
     def test_register_dependencies(self):
         depnt = {'path':rndstr()}
         depcies = [{'path':rndstr()}, {'path':rndstr()}]
@@ -168,6 +418,233 @@ class ResponseCacheTest(testtools.TestCase):
         for k in dependents_keys:
             self.assertIn(k, set(results))
 
+    def test_local_cache(self):
+        req, resp = self._make_request_response()
+        key_parts = dict(path=req.path, params=req.params, role=rndstr())
+        key = self.cache.make_key(**key_parts)
+        self.cache.local_cache = LocalCache()
+
+        self.cache.store_response(response=resp, **key_parts)
+        cached_resource = self.cache.load_response(**key_parts)
+        self.assertEqual(cached_resource['data'], resp.data)
+        self.assertEqual(self.cache.local_cache.get(key), cached_resource)
+
+        # a delete must not leave the local copy behind
+        self.cache.delete_response(**key_parts)
+        self.assertIsNone(self.cache.local_cache.get(key))
+        self.assertEqual(self.cache.load_response(**key_parts), {})
+
+    def test_invalidation_listener(self):
+        req, resp = self._make_request_response()
+        key_parts = dict(path=req.path, params=req.params, role=rndstr())
+        key = self.cache.make_key(**key_parts)
+
+        # another worker, with its own local copy of the response
+        worker_cache = ResponseCache(self.store, local_cache=LocalCache())
+        listener = worker_cache.listen_invalidations()
+        self.addCleanup(listener.stop)
+        self.cache.store_response(response=resp, **key_parts)
+        worker_cache.load_response(**key_parts)
+        self.assertIsNotNone(worker_cache.local_cache.get(key))
+
+        # give the listener some time to subscribe
+        time.sleep(0.2)
+        self.cache.delete_response(**key_parts)
+        for i in range(50):
+            if worker_cache.local_cache.get(key) is None:
+                break
+            time.sleep(0.02)
+        self.assertIsNone(worker_cache.local_cache.get(key))
+
+    def test_delete_response_invalidates(self):
+        req, resp = self._make_request_response()
+        key_parts = dict(path=req.path, params=req.params, role=rndstr())
+        key = self.cache.make_key(**key_parts)
+        self.cache.local_cache = LocalCache()
+        self.cache.store_response(response=resp, **key_parts)
+        self.cache.load_response(**key_parts)
+        pubsub = self.server.pubsub(ignore_subscribe_messages=True)
+        self.addCleanup(pubsub.close)
+        pubsub.subscribe(self.store.channel)
+        pubsub.get_message(timeout=1.0)
+
+        self.cache.delete_response(**key_parts)
+        self.assertIsNone(self.cache.local_cache.get(key))
+        for i in range(50):
+            message = pubsub.get_message(timeout=0.02)
+            if message:
+                break
+        self.assertEqual(json.loads(to_native(message['data'], 'utf8')), 
+                         [key])
+
+    def test_first_fill_is_not_published(self):
+        req, resp = self._make_request_response()
+        key_parts = dict(path=req.path, params=req.params, role=rndstr())
+        key = self.cache.make_key(**key_parts)
+        self.cache.local_cache = LocalCache()
+        pubsub = self.server.pubsub(ignore_subscribe_messages=True)
+        self.addCleanup(pubsub.close)
+        pubsub.subscribe(self.store.channel)
+        pubsub.get_message(timeout=1.0)
+
+        self.cache.store_response(response=resp, ttl=60, **key_parts)
+        self.assertIsNone(pubsub.get_message(timeout=0.2))
+        self.cache.store_response(response=resp, ttl=60, **key_parts)
+        message = pubsub.get_message(timeout=1.0)
+        self.assertEqual(json.loads(to_native(message['data'], 'utf8')), 
+                         [key])
+        self.assertTrue(0<self.server.ttl(
+            self.store.key(key, 'response'))<=60)
+
+    def test_overwrite_invalidates_local_copies(self):
+        req, resp = self._make_request_response()
+        key_parts = dict(path=req.path, params=req.params, role=rndstr())
+        key = self.cache.make_key(**key_parts)
+        cache = ResponseCache(self.store, local_cache=LocalCache())
+        worker_cache = ResponseCache(self.store, local_cache=LocalCache())
+        listener = worker_cache.listen_invalidations()
+        self.addCleanup(listener.stop)
+        cache.store_response(response=resp, **key_parts)
+        worker_cache.load_response(**key_parts)
+
+        time.sleep(0.2)
+        cache.store_response(response=resp._replace(data='new'), **key_parts)
+        for i in range(50):
+            if worker_cache.local_cache.get(key) is None:
+                break
+            time.sleep(0.02)
+        self.assertEqual(worker_cache.load_response(**key_parts)['data'], 
+                         'new')
+
+    def test_delete_response_cascade(self):
+        responses = []
+        for i in range(4):
+            req, resp = self._make_request_response()
+            key_parts = dict(path=req.path, params=req.params, role=rndstr())
+            self.cache.store_response(response=resp, **key_parts)
+            responses.append(key_parts)
+
+        # a chain where each response depends on the previous one, with the
+        # first also depending on the last
+        for dependency, dependent in zip(responses, responses[1:]):
+            self.cache.register_dependencies(dependent, dependency)
+        self.cache.register_dependencies(responses[0], responses[-1])
+
+        purged = self.cache.delete_response(**responses[1])
+        self.assertEqual(purged, 4)
+        self.assertEqual(self.cache.load_response(**responses[1]), {})
+        self.assertEqual(self.cache.load_response(**responses[2]), {})
+        self.assertEqual(self.cache.load_response(**responses[3]), {})
+        self.assertEqual(self.cache.load_response(**responses[0]), {})
+
+    def test_variants(self):
+        req, resp = self._make_request_response()
+        key_parts = dict(path=req.path, params=req.params, role=rndstr())
+        self.assertNotEqual(
+            self.cache.make_key(variant='application/msgpack', **key_parts),
+            self.cache.make_key(**key_parts))
+        self.cache.store_response(response=resp, **key_parts)
+        variant = self._make_request_response()[1]
+        self.cache.store_response(response=variant, 
+                                  variant='application/msgpack', **key_parts)
+
+        self.assertEqual(self.cache.load_response(**key_parts)['data'], 
+                         resp.data)
+        self.assertEqual(self.cache.load_response(
+            variant='application/msgpack', **key_parts)['data'], variant.data)
+
+        # all the representations go with the response
+        self.assertEqual(self.cache.delete_response(**key_parts), 2)
+        self.assertEqual(self.cache.load_response(
+            variant='application/msgpack', **key_parts), {})
+
+    def test_delete_response_max_depth(self):
+        responses = []
+        for i in range(3):
+            req, resp = self._make_request_response()
+            key_parts = dict(path=req.path, params=req.params, role=rndstr())
+            self.cache.store_response(response=resp, **key_parts)
+            responses.append(key_parts)
+        for dependency, dependent in zip(responses, responses[1:]):
+            self.cache.register_dependencies(dependent, dependency)
+
+        purged = self.cache.delete_response(max_depth=1, **responses[0])
+        self.assertEqual(purged, 2)
+        self.assertEqual(self.cache.load_response(**responses[1]), {})
+        self.assertNotEqual(self.cache.load_response(**responses[2]), {})
+
+    def test_large_dependents_sets(self):
+        self.store.small_set_size = 10
+        dependency = {'path':rndstr()}
+        dependents = [{'path':rndstr()} for i in range(100)]
+        for d in dependents:
+            self.cache.register_dependencies(d, dependency)
+
+        # iterated with SSCAN, the whole set must be returned
+        results = self.cache.find_dependents(count=7, **dependency)
+        self.assertEqual(len(results), 100)
+
+        self.cache.register_dependencies(
+            dependents[0], [{'path':rndstr()} for i in range(50)])
+        self.cache.drop_dependencies(count=7, **dependents[0])
+        rkey = self.raw_key(dependents[0], data_type='dependencies')
+        self.assertEqual(self.server.scard(rkey), 0)
+        results = self.cache.find_dependents(**dependency)
+        self.assertEqual(len(results), 99)
+
+    def test_single_flight(self):
+        path = rndstr()
+        events = []
+
+        def fill(delay):
+            with self.cache.single_flight(path) as leader:
+                events.append(('enter', leader))
+                time.sleep(delay)
+                events.append(('exit', leader))
+
+        leader = threading.Thread(target=fill, args=(0.2,))
+        leader.start()
+        time.sleep(0.05)
+        follower = threading.Thread(target=fill, args=(0,))
+        follower.start()
+        leader.join()
+        follower.join()
+        # the follower only gets in once the leader is done
+        self.assertEqual(events, [('enter', True), ('exit', True), 
+                                  ('enter', False), ('exit', False)])
+        # the lock is released for the next miss
+        with self.cache.single_flight(path) as leader:
+            self.assertTrue(leader)
+
+    def test_single_flight_across_processes(self):
+        path = rndstr()
+        # another process filling the same entry
+        lock = self.store.lock(self.cache.make_key(path), timeout=10)
+        self.assertTrue(lock.acquire(blocking=False))
+        started = time.time()
+        with self.cache.single_flight(path, timeout=0.1) as leader:
+            self.assertFalse(leader)
+            self.assertTrue(time.time() - started>=0.1)
+
+    def test_early_expiration(self):
+        req, resp = self._make_request_response()
+        resp = resp._replace(last_modified=datetime.utcnow())
+        key_parts = dict(path=req.path, params=req.params)
+
+        # quickly computed and far from expiry: never recomputed early
+        self.cache.store_response(response=resp, delta=0, **key_parts)
+        self.assertNotEqual(
+            self.cache.load_response(ttl=60, beta=1, **key_parts), {})
+        # past expiry: left to the caller, which may serve it stale
+        self.assertNotEqual(
+            self.cache.load_response(ttl=-1, beta=1, **key_parts), {})
+        # slow to compute: recomputed well ahead of expiry
+        self.cache.store_response(response=resp, delta=10**6, **key_parts)
+        self.assertEqual(
+            self.cache.load_response(ttl=60, beta=1, **key_parts), {})
+        # only when asked to
+        self.assertNotEqual(self.cache.load_response(**key_parts), {})
+
 #    def test_deleting_resource_deletes_its_dependencts(self):
 #        req, resp = self._make_request_response()
 
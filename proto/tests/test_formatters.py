@@ -2,8 +2,16 @@ import unittest
 import json
 from datetime import datetime, date, time
 from decimal import Decimal
+from io import BytesIO
 
-from .formatters import JSONFormatter
+from proto.formatters import (JSON_BACKENDS, JSONFormatter, cbor2, 
+                              cbor_input_formatter, cbor_output_formatter,
+                              get_json_backend, json_array_input_stream, 
+                              json_array_output_stream, 
+                              json_iter_output_formatter, msgpack, 
+                              msgpack_input_formatter, 
+                              msgpack_output_formatter, ndjson_input_stream,
+                              ndjson_output_stream)
 
 class JsonFormatterTest(unittest.TestCase):
     def test_handles_primitives(self):
@@ -64,3 +72,160 @@ class JsonFormatterTest(unittest.TestCase):
 
         for k, v in d.iteritems():
             self.assertEqual(d2[k], float(v))
+
+    def test_handles_bytes(self):
+        encoder = JSONFormatter()
+        self.assertEqual(encoder.encode([b'abc', b'\xff']), '["abc", "/w=="]')
+
+    def test_dispatch(self):
+        class Money(Decimal): pass
+        class Euros(Money): pass
+        encoder = JSONFormatter()
+        encoder.add_formatter(Money, lambda o: '{0:.2f}'.format(o))
+        self.assertEqual(encoder.encode([Euros('1.5'), Decimal('1.5')]), 
+                         '["1.50", 1.5]')
+        # the conversion of each type is looked up once
+        self.assertEqual(set(encoder.dispatch), set([Euros, Decimal]))
+
+        # the most specific formatter wins
+        encoder.add_formatter(Euros, lambda o: '{0:.2f} EUR'.format(o))
+        self.assertEqual(encoder.dispatch, {})
+        self.assertEqual(encoder.encode(Euros('1.5')), '"1.50 EUR"')
+
+        self.assertRaises(TypeError, encoder.encode, object())
+
+    def test_iter_output_formatter(self):
+        d = [dict(k=datetime(2016, 2, 29), v=Decimal('0.5'))] * 500
+        chunks = list(json_iter_output_formatter(d, chunk_size=1024))
+        self.assertTrue(len(chunks) > 1)
+        self.assertEqual(b''.join(chunks).decode('utf8'), 
+                         json.dumps(d, cls=JSONFormatter))
+
+
+class JSONBackendsTest(unittest.TestCase):
+    # values to encode the same way whatever the library
+    conformance = [
+        (datetime(2016, 2, 29, 12, 30, 15, 500), '2016-02-29T12:30:15.000500'),
+        (date(2016, 2, 29), '2016-02-29'),
+        (time(12, 30), '12:30:00'),
+        (Decimal('0.5'), 0.5),
+        (b'abc', 'abc'),
+        (b'\xff', '/w=='),
+        ({'k': [b'\xff']}, {'k': ['/w==']}),
+        (set(['a']), ['a']),
+        (('a', 1), ['a', 1]),
+        (u'\xe9t\xe9', u'\xe9t\xe9'),
+        (2 ** 70, 2 ** 70),
+        ({'k': [None, True, 1.5]}, {'k': [None, True, 1.5]}),
+    ]
+
+    def backends(self):
+        for name, backend in JSON_BACKENDS:
+            try:
+                yield backend()
+            except ImportError:
+                # not installed
+                pass
+
+    def test_conformance(self):
+        for backend in self.backends():
+            for value, expected in self.conformance:
+                encoded = backend.dumps(value)
+                self.assertEqual(json.loads(encoded), expected, 
+                                 '{0}: {1!r}'.format(backend.name, value))
+                self.assertEqual(backend.loads(encoded), expected)
+            self.assertRaises(TypeError, backend.dumps, object())
+            self.assertRaises(ValueError, backend.loads, '{')
+
+    def test_custom_formatters(self):
+        encoder = JSONFormatter()
+        encoder.add_formatter(Decimal, str)
+        for name, backend in JSON_BACKENDS:
+            try:
+                backend = backend(encoder)
+            except ImportError:
+                continue
+            self.assertEqual(json.loads(backend.dumps([Decimal('0.5')])), 
+                             ['0.5'])
+
+    def test_get_json_backend(self):
+        self.assertEqual(get_json_backend('json').name, 'json')
+        self.assertIn(get_json_backend().name, [n for n, b in JSON_BACKENDS])
+        self.assertRaises(ValueError, get_json_backend, 'nothing')
+
+
+class BinaryFormattersTest(unittest.TestCase):
+    d = {
+        'k1': b'\xff',
+        'k2': Decimal('0.5'),
+        'k3': date(2016, 2, 29),
+        'k4': [1, u'\xe9t\xe9', None],
+    }
+
+    @unittest.skipIf(msgpack is None, 'msgpack is not installed')
+    def test_msgpack(self):
+        d2 = msgpack_input_formatter(msgpack_output_formatter(self.d))
+        # bytes are native
+        self.assertEqual(d2['k1'], b'\xff')
+        self.assertEqual(d2['k2'], 0.5)
+        self.assertEqual(d2['k3'], '2016-02-29')
+        self.assertEqual(d2['k4'], self.d['k4'])
+
+    @unittest.skipIf(cbor2 is None, 'cbor2 is not installed')
+    def test_cbor(self):
+        d2 = cbor_input_formatter(cbor_output_formatter(self.d))
+        self.assertEqual(d2['k1'], b'\xff')
+        self.assertEqual(d2['k4'], self.d['k4'])
+
+
+class InputStreamTest(unittest.TestCase):
+    records = [1, -1.5e3, u'\xe9t\xe9', {'a': [1, 2]}, None, True, 23456]
+
+    def test_json_array(self):
+        body = json.dumps(self.records, ensure_ascii=False).encode('utf8')
+        # records split across chunks of any size
+        for chunk_size in (1, 2, 7, 1024):
+            self.assertEqual(
+                list(json_array_input_stream(BytesIO(body), chunk_size)),
+                self.records)
+        self.assertEqual(list(json_array_input_stream(BytesIO(b' [ ] '))), [])
+
+    def test_invalid_json_array(self):
+        for body in (b'[1, 2', b'{}', b'[1 2]', b'[1,]', b'[1.]', 
+                     b'[1]garbage', b'[1] [2]', b'[] x'):
+            self.assertRaises(ValueError, list, 
+                              json_array_input_stream(BytesIO(body), 1))
+
+    def test_json_array_is_lazy(self):
+        body = BytesIO(b'[1, 2, ' + b'3, ' * 10000 + b'4]')
+        records = json_array_input_stream(body, 16)
+        self.assertEqual(next(records), 1)
+        self.assertTrue(body.tell() < 100)
+
+    def test_ndjson(self):
+        body = b'\n'.join(json.dumps(r).encode('utf8') 
+                          for r in self.records) + b'\n\n'
+        for chunk_size in (1, 2, 7, 1024):
+            self.assertEqual(
+                list(ndjson_input_stream(BytesIO(body), chunk_size)),
+                self.records)
+
+
+class OutputStreamTest(unittest.TestCase):
+    def records(self):
+        for i in range(100):
+            yield dict(i=i, day=date(2016, 2, 29))
+
+    def test_json_array(self):
+        chunks = list(json_array_output_stream(self.records(), 
+                                               chunk_size=256))
+        self.assertTrue(len(chunks) > 1)
+        self.assertEqual(json.loads(b''.join(chunks).decode('utf8')), 
+                         [dict(i=i, day='2016-02-29') for i in range(100)])
+        self.assertEqual(b''.join(json_array_output_stream([])), b'[]')
+
+    def test_ndjson(self):
+        body = b''.join(ndjson_output_stream(self.records()))
+        lines = body.decode('utf8').splitlines()
+        self.assertEqual([json.loads(l)['i'] for l in lines], 
+                         list(range(100)))
@@ -0,0 +1,90 @@
+import testtools
+import zlib
+
+import falcon
+from falcon import testing as falcon_testing, Response
+
+from proto.cache import compress_body, decompress_body
+from proto.middleware import CompressionMiddleware
+
+class CompressionMiddlewareTest(testtools.TestCase):
+    def setUp(self):
+        super(CompressionMiddlewareTest, self).setUp()
+        self.middleware = CompressionMiddleware(min_size=100)
+        self.body = b'{"a": 1}' * 50
+
+    def process(self, response, accept_encoding='gzip, deflate'):
+        headers = {}
+        if accept_encoding:
+            headers['Accept-Encoding'] = accept_encoding
+        request = falcon.Request(falcon_testing.create_environ(
+            path='/api/test', headers=headers))
+        self.middleware.process_response(request, response, None, True)
+        return response
+
+    def create_response(self, data=None):
+        response = Response()
+        response.data = data if data is not None else self.body
+        return response
+
+    def test_compresses(self):
+        response = self.process(self.create_response())
+        self.assertEqual(response.get_header('Content-Encoding'), 'gzip')
+        self.assertEqual(response.get_header('Vary'), 'Accept-Encoding')
+        self.assertEqual(decompress_body(response.data, 'gzip'), self.body)
+
+        response = self.create_response()
+        response.set_header('ETag', '"abc"')
+        response = self.process(response, 'deflate')
+        self.assertEqual(response.get_header('ETag'), '"abc-deflate"')
+        self.assertEqual(response.get_header('Content-Encoding'), 'deflate')
+        self.assertEqual(decompress_body(response.data, 'deflate'), self.body)
+
+    def test_compresses_text_body(self):
+        response = Response()
+        response.body = self.body.decode('utf8')
+        response = self.process(response)
+        self.assertEqual(response.get_header('Content-Encoding'), 'gzip')
+        self.assertIsNone(response.body)
+        self.assertEqual(decompress_body(response.data, 'gzip'), self.body)
+        # too small
+        response = Response()
+        response.body = u'{}'
+        self.assertEqual(self.process(response).body, u'{}')
+
+    def test_leaves_alone(self):
+        # not accepted
+        response = self.process(self.create_response(), 'identity')
+        self.assertIsNone(response.get_header('Content-Encoding'))
+        self.assertEqual(response.data, self.body)
+        # too small
+        response = self.process(self.create_response(b'{}'))
+        self.assertIsNone(response.get_header('Content-Encoding'))
+        # already compressed
+        response = self.create_response(compress_body(self.body, 'deflate'))
+        response.set_header('Content-Encoding', 'deflate')
+        self.assertEqual(self.process(response).data,
+                         compress_body(self.body, 'deflate'))
+
+    def test_reuses_cached_compression(self):
+        response = self.create_response()
+        response.context['compressed'] = ('gzip', b'stored')
+        self.assertEqual(self.process(response).data, b'stored')
+        # unless it's not what the client accepts
+        response = self.create_response()
+        response.context['compressed'] = ('gzip', b'stored')
+        response = self.process(response, 'deflate')
+        self.assertEqual(decompress_body(response.data, 'deflate'), self.body)
+
+    def test_streams(self):
+        response = Response()
+        response.stream = iter([self.body] * 10)
+        response = self.process(response)
+        self.assertEqual(response.get_header('Content-Encoding'), 'gzip')
+        chunks = list(response.stream)
+        self.assertEqual(decompress_body(b''.join(chunks), 'gzip'),
+                         self.body * 10)
+        # each chunk sent as it comes
+        self.assertEqual(len(chunks), 11)
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.assertEqual(decompressor.decompress(chunks[0]), self.body)
@@ -0,0 +1,147 @@
+import os
+import shutil
+import tempfile
+import testtools
+from datetime import date
+from uuid import UUID, uuid4
+
+from proto.routing import Router, RouteCache, RoutingError
+from proto.wrapper import FuncSpec
+
+def cached_action(item_id, page=1, *args, **kwargs): pass
+
+class RouterTest(testtools.TestCase):
+    def setUp(self):
+        super(RouterTest, self).setUp()
+        self.router = Router()
+
+    def test_get_converters(self):
+        converters = self.router._get_converters(
+            '/items/{item_id:int}/{day:date}/{ref:uuid}/{name:slug}/{x}')
+        self.assertEqual(set(converters), set(['item_id', 'day', 'ref', 
+                                               'name']))
+        self.assertEqual(converters['item_id']('3'), 3)
+        self.assertEqual(converters['day']('2016-02-29'), date(2016, 2, 29))
+        ref = uuid4()
+        self.assertEqual(converters['ref'](str(ref)), ref)
+        self.assertEqual(converters['name']('a-slug'), 'a-slug')
+        self.assertRaises(ValueError, converters['name'], 'Not a slug')
+
+    def test_custom_converters(self):
+        self.router.add_converter('upper', lambda v: v.upper())
+        converters = self.router._get_converters('/items/{code:upper}')
+        self.assertEqual(converters['code']('abc'), 'ABC')
+        # registered per router
+        self.assertNotIn('upper', Router().converters)
+
+    def test_unknown_converters(self):
+        # urls can't evaluate arbitrary code
+        self.assertRaises(RoutingError, self.router._get_converters,
+                          '/items/{item_id:__import__("os").getcwd}')
+
+    def test_falcon_url_template(self):
+        self.assertEqual(
+            self.router._falcon_url_template('/items/{item_id:int}/{x}'),
+            '/items/{item_id}/{x}')
+
+    def test_url_builder(self):
+        def get_item(item_id, day): pass
+        self.router.add_route('/items/{item_id:int}/{day:date}', get_item)
+        build = self.router.url_builder(get_item, prefix='/api')
+        self.assertEqual(build(item_id=3, day='2016-02-29'), 
+                         '/api/items/3/2016-02-29')
+        # values are percent-encoded
+        self.assertEqual(build(item_id='a b/c', day=u'\xe9'), 
+                         '/api/items/a%20b%2Fc/%C3%A9')
+        # compiled once
+        self.assertIs(self.router.url_builder(get_item, prefix='/api'), build)
+        self.assertEqual(self.router.action_to_url(get_item), 
+                         '/items/{item_id}/{day}')
+
+    def test_url_builder_hint(self):
+        def get_item(item_id): pass
+        self.router.add_route('/items/{item_id}', get_item)
+        self.router.add_route('/things/{item_id}', get_item)
+        self.assertEqual(self.router.url_builder(get_item)(item_id=1), 
+                         '/items/1')
+        self.assertEqual(
+            self.router.url_builder(get_item, hint='things')(item_id=1), 
+            '/things/1')
+        self.assertRaises(RoutingError, self.router.url_builder, get_item, 
+                          hint='nothing')
+
+    def test_parse_url(self):
+        url = '/items/{item_id:int}/{x}'
+        self.assertEqual(self.router.parse_url(url), 
+                         ('/items/{item_id}/{x}', {'item_id': 'int'}))
+        self.assertIs(self.router.parse_url(url), self.router.parse_url(url))
+
+    def test_table(self):
+        def get_item(item_id): pass
+        self.router.add_route('/items/{item_id:int}', get_item, 
+                              methods=['GET', 'PUT'], version=2)
+        table = list(self.router.table())
+        self.assertEqual([(r['url'], r['method'], r['version']) 
+                          for r in table],
+                         [('/items/{item_id}', 'GET', 2), 
+                          ('/items/{item_id}', 'PUT', 2)])
+        self.assertEqual(table[0]['converters'], ['item_id'])
+        self.assertTrue(table[0]['action'].endswith('.get_item'))
+
+
+class RouteCacheTest(testtools.TestCase):
+    def setUp(self):
+        super(RouteCacheTest, self).setUp()
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        self.path = os.path.join(tmp_dir, 'routes.cache')
+
+    def test_round_trip(self):
+        cache = RouteCache(self.path)
+        self.assertIsNone(cache.get_argspec(cached_action))
+        argspec = FuncSpec(cached_action).argspec
+        cache.set_argspec(cached_action, argspec)
+        router = Router()
+        router.parse_url('/items/{item_id:int}')
+        cache.set_urls(router.parsed_urls)
+        cache.dump()
+
+        cache = RouteCache(self.path)
+        self.assertEqual(cache.get_argspec(cached_action), argspec)
+        self.assertEqual(cache.urls, router.parsed_urls)
+        specs = FuncSpec(cached_action, argspec=cache.get_argspec(cached_action))
+        self.assertEqual(specs.kwargsdict, {'page': 1})
+        self.assertEqual(specs.args, ['item_id'])
+        self.assertEqual(specs.varargs, 'args')
+
+    def test_removed_urls(self):
+        cache = RouteCache(self.path)
+        router = Router()
+        router.parse_url('/items/{item_id:int}')
+        router.parse_url('/removed/{item_id:int}')
+        cache.set_urls(router.parsed_urls)
+        cache.dump()
+
+        router = Router()
+        router.cached_urls.update(RouteCache(self.path).urls)
+        self.assertEqual(router.parse_url('/items/{item_id:int}'),
+                         cache.urls['/items/{item_id:int}'])
+        # only the urls of this run's routes are written back
+        cache.set_urls(router.parsed_urls)
+        self.assertEqual(list(cache.urls), ['/items/{item_id:int}'])
+
+    def test_modified_module(self):
+        cache = RouteCache(self.path)
+        cache.set_argspec(cached_action, FuncSpec(cached_action).argspec)
+        cache.mtimes[__name__] -= 1
+        self.assertIsNone(cache.get_argspec(cached_action))
+
+    def test_unreadable_file(self):
+        with open(self.path, 'wb') as f:
+            f.write(b'not a cache')
+        cache = RouteCache(self.path)
+        self.assertEqual(cache.urls, {})
+        # nothing to save
+        cache.dump()
+        with open(self.path, 'rb') as f:
+            self.assertEqual(f.read(), b'not a cache')
@@ -1,8 +1,16 @@
+import json
+import logging
+import threading
 import testtools
+from io import BytesIO
 
+import falcon
 from falcon import testing as falcon_testing, Response
 
-from proto.wrapper import (FuncSpec, VersionMapper, Wrapper)
+from proto._compat import iteritems
+from proto.formatters import (json_output_formatter, ndjson_input_stream, 
+                              ndjson_output_stream)
+from proto.wrapper import (FuncSpec, LimitedStream, VersionMapper, Wrapper)
 
 from . import rndstr
 
@@ -49,15 +57,62 @@ class VersionMapperTest(BaseTest):
         self.version_mapper = VersionMapper(
             api_versioned_routes=versioned_routes)
 
-        self.request = self.create_environ()
+        self.request = falcon.Request(self.create_environ())
 
     def test_get_route(self):
         route = self.version_mapper.get_route(self.request, url_version=None)
         self.assertEqual(route['name'], 'route_None')
         route = self.version_mapper.get_route(self.request, url_version=2)
         self.assertEqual(route['name'], 'route_2')
-        # TODO get version from query string params
-        # TODO get version from request header
+        route = self.version_mapper.get_route(self.request, 
+                                              url_version='latest')
+        self.assertEqual(route['name'], 'route_2')
+
+    def _request(self, query_string='', headers=None):
+        return falcon.Request(falcon_testing.create_environ(
+            path='/api/test', query_string=query_string, headers=headers))
+
+    def test_negotiation(self):
+        vm = self.version_mapper
+        request = self._request(query_string='api_version=1')
+        self.assertEqual(vm.get_route(request)['name'], 'route_1')
+        request = self._request(headers={'X-API-Version': '2'})
+        self.assertEqual(vm.get_route(request)['name'], 'route_2')
+        request = self._request(
+            headers={'Accept': 'application/vnd.test.v1+json'})
+        self.assertEqual(vm.get_route(request)['name'], 'route_1')
+        # agreeing sources
+        request = self._request(headers={'X-API-Version': '1'})
+        self.assertEqual(vm.get_route(request, url_version='1')['name'], 
+                         'route_1')
+        # conflicting sources
+        request = self._request(query_string='api_version=2',
+                                headers={'X-API-Version': '1'})
+        self.assertRaises(falcon.HTTPBadRequest, vm.get_route, request)
+
+    def test_unregistered_versions(self):
+        vm = self.version_mapper
+        # the closest version below the requested one is served
+        self.assertEqual(vm.get_route(self.request, url_version='5')['name'],
+                         'route_2')
+        vm.api_versioned_routes = {
+            2: {'name': 'route_2', 'action_func': None}}
+        self.assertIsNone(vm.get_route(self.request, url_version='1'))
+        self.assertIsNone(vm.get_route(self.request, url_version='abc'))
+
+    def test_handlers(self):
+        def abc(): pass
+        def cba(): pass
+        vm = VersionMapper({1: {'name': 'route_1', 'action_func': abc},
+                            2: {'name': 'route_2', 'action_func': cba}})
+        # versions from urls are strings
+        self.assertEqual(vm.get_route(self.request, url_version='1')['name'],
+                         'route_1')
+        # without a version-less route, the latest version is the default
+        self.assertEqual(vm.get_route(self.request)['name'], 'route_2')
+        self.assertIsNone(vm.get_route(self.request, url_version='0'))
+        self.assertRaises(falcon.HTTPNotFound, vm, self.request, {}, 
+                          version='0')
 
     def test_get_action(self):
         params = {'version': 1}
@@ -140,6 +195,272 @@ class WrapperTest(BaseTest):
         wrapper = Wrapper(app, abc, None, None)
         self.assertFalse(wrapper.requires_auth)
 
+    def test_invocation_plan(self):
+        def abc(a, __user__, __app__, d=3, e=None): return (a, d, e)
+        app = object()
+        wrapper = Wrapper(app, abc, [], [])
+        # only what the action expects is resolved on each call
+        self.assertEqual([name for name, injector in wrapper.injectors],
+                         ['__app__', '__user__'])
+        self.assertEqual(wrapper.query_kwargs, frozenset(['d', 'e']))
+
+        request = falcon.Request(self.create_environ())
+        request.context['user'] = user = object()
+        response = self.create_response()
+        params = wrapper.inject(dict(a=1), request, response)
+        self.assertEqual(params, dict(a=1, __user__=user, __app__=app))
+
+    def create_upload(self, body):
+        return falcon.Request(falcon_testing.create_environ(
+            path='/api/test', method='POST', body=body))
+
+    def test_streamed_data(self):
+        def ingest(__data__): return __data__
+        wrapper = Wrapper(None, ingest, [], [], 
+                          input_stream=ndjson_input_stream)
+        request = self.create_upload(b'{"a": 1}\n{"a": 2}\n')
+        data = wrapper.read_data(request)
+        self.assertEqual(next(data), {'a': 1})
+        self.assertEqual(list(data), [{'a': 2}])
+
+        data = wrapper.read_data(self.create_upload(b'{"a": 1}\n{"a": '))
+        self.assertEqual(next(data), {'a': 1})
+        self.assertRaises(falcon.HTTPBadRequest, next, data)
+
+    def test_max_body_size(self):
+        def ingest(__data__): return __data__
+        wrapper = Wrapper(None, ingest, [], [], max_body_size=8)
+        self.assertEqual(wrapper.read_data(self.create_upload(b'12345678')),
+                         b'12345678')
+        self.assertRaises(falcon.HTTPError, wrapper.read_data, 
+                          self.create_upload(b'123456789'))
+
+        # also enforced while reading a body of unknown length
+        stream = LimitedStream(BytesIO(b'1\n2\n3\n4\n5\n6\n'), 8)
+        records = ndjson_input_stream(stream, 4)
+        self.assertEqual(next(records), 1)
+        self.assertRaises(falcon.HTTPError, list, records)
+
+    def create_stale_app(self, calls, headers=None):
+        # an app whose cache only holds a stale response
+        class MockCache(object):
+            def make_key(self, path, params=None, query_string=None, 
+                         variant=None):
+                return path
+            def store_response(self, path, response, **kwargs):
+                calls.append(('store', response.data, kwargs['ttl']))
+        class MockBackground(object):
+            def apply_async(self, func, args):
+                calls.append('background')
+                func(*args)
+        class MockApp(object):
+            cache = MockCache()
+            background = MockBackground()
+            revalidations = set()
+            revalidations_lock = threading.Lock()
+            def populate_from_cache(self, request, response, **kwargs):
+                calls.append(('load', kwargs))
+                response.data = 'stale'
+                for name, value in iteritems(headers or {}):
+                    response.set_header(name, value)
+                response.context['stale'] = True
+                return True
+        return MockApp()
+
+    def test_revalidates_stale_responses(self):
+        def abc(): return 'fresh'
+        calls = []
+        app = self.create_stale_app(calls)
+        wrapper = Wrapper(app, abc, [], [], cacheable=True, 
+                          fresh_ttl=10, stale_ttl=50)
+        request = falcon.Request(self.create_environ())
+        response = self.create_response()
+        wrapper(request, response)
+
+        # the stale response is served, and refreshed
+        self.assertEqual(response.data, 'stale')
+        self.assertEqual(calls, [
+            ('load', dict(fresh_ttl=10, stale_ttl=50, beta=None, 
+                          variant=None)),
+            'background',
+            ('store', 'fresh', 60),
+        ])
+        self.assertEqual(app.revalidations, set())
+
+    def test_failed_revalidation_is_logged(self):
+        def abc(): raise RuntimeError('failed')
+        calls = []
+        wrapper = Wrapper(self.create_stale_app(calls), abc, [], [], 
+                          cacheable=True, fresh_ttl=10, stale_ttl=50)
+        records = []
+        class Handler(logging.Handler):
+            def emit(self, record):
+                records.append(record)
+        handler = Handler()
+        logging.getLogger('proto.wrapper').addHandler(handler)
+        self.addCleanup(logging.getLogger('proto.wrapper').removeHandler, 
+                        handler)
+
+        response = self.create_response()
+        wrapper(falcon.Request(self.create_environ()), response)
+        self.assertEqual(response.data, 'stale')
+        self.assertEqual(len(records), 1)
+        self.assertIsInstance(records[0].exc_info[1], RuntimeError)
+
+    def test_revalidates_with_request_in_foreground(self):
+        # the request isn't handed to a background refresh
+        def abc(__request__): return 'fresh'
+        calls = []
+        wrapper = Wrapper(self.create_stale_app(calls), abc, [], [], 
+                          cacheable=True, fresh_ttl=10, stale_ttl=50)
+        response = self.create_response()
+        wrapper(falcon.Request(self.create_environ()), response)
+        self.assertEqual(response.data, 'fresh')
+        self.assertEqual(calls[1:], [('store', 'fresh', 60)])
+
+    def test_revalidates_compressed_in_foreground(self):
+        def abc(__request__): return 'fresh'
+        calls = []
+        app = self.create_stale_app(calls, {
+            'Content-Encoding': 'gzip', 'Vary': 'Accept-Encoding'})
+        wrapper = Wrapper(app, abc, [], [], cacheable=True, 
+                          fresh_ttl=10, stale_ttl=50)
+        response = self.create_response()
+        wrapper(falcon.Request(self.create_environ()), response)
+        self.assertEqual(response.data, 'fresh')
+        # left to `CompressionMiddleware` to compress again
+        self.assertIsNone(response.get_header('Content-Encoding'))
+        self.assertIsNone(response.get_header('Vary'))
+        self.assertNotIn('stale', response.context)
+
+    def test_revalidates_etagged_in_foreground(self):
+        def abc(__request__): return 'fresh'
+        calls = []
+        app = self.create_stale_app(calls, {
+            'ETag': '"v1"', 'Last-Modified': 'Tue, 01 Jan 2019 00:00:00 GMT'})
+        wrapper = Wrapper(app, abc, [], [], cacheable=True, 
+                          fresh_ttl=10, stale_ttl=50)
+        response = self.create_response()
+        wrapper(falcon.Request(self.create_environ()), response)
+        # neither sent nor stored with the new body
+        self.assertIsNone(response.etag)
+        self.assertIsNotNone(response.last_modified)
+        self.assertNotEqual(response.get_header('Last-Modified'), 
+                            'Tue, 01 Jan 2019 00:00:00 GMT')
+        self.assertEqual(response.status, falcon.HTTP_200)
+        self.assertEqual(calls[1:], [('store', 'fresh', 60)])
+
+    def test_negotiation(self):
+        def abc(): return dict(a=1)
+        wrapper = Wrapper(None, abc, [], [], representations=[
+            ('application/json', [json_output_formatter]),
+            ('application/msgpack', [lambda o: 'msgpack']),
+        ])
+
+        def call(accept):
+            environ = self.create_environ()
+            if accept:
+                environ['HTTP_ACCEPT'] = accept
+            response = self.create_response()
+            wrapper(falcon.Request(environ), response)
+            return response
+
+        response = call(None)
+        self.assertEqual(response.content_type, 'application/json')
+        self.assertEqual(json.loads(response.data), dict(a=1))
+        self.assertEqual(call('*/*').content_type, 'application/json')
+        response = call('application/msgpack, application/json;q=0.5')
+        self.assertEqual(response.content_type, 'application/msgpack')
+        self.assertEqual(response.data, 'msgpack')
+        self.assertEqual(response.get_header('Vary'), 'Accept')
+        self.assertRaises(falcon.HTTPNotAcceptable, call, 'text/html')
+
+        # the default representation is cached under the plain key
+        request = falcon.Request(self.create_environ())
+        self.assertIsNone(wrapper.negotiate(request, self.create_response()))
+
+        # streams aren't negotiated
+        self.assertRaises(ValueError, Wrapper, None, abc, [], [], 
+                          output_stream=ndjson_output_stream,
+                          representations=[('application/json', [])])
+
+    def test_negotiation_with_versioned_media_type(self):
+        def abc(): return dict(a=1)
+        def cba(): return dict(a=2)
+        representations = [
+            ('application/json', [json_output_formatter]),
+            ('application/x-msgpack', [lambda o: 'msgpack']),
+        ]
+        version_mapper = VersionMapper({
+            1: {'action_func': Wrapper(None, abc, [], [], 
+                                       representations=representations)},
+            2: {'action_func': Wrapper(None, cba, [], [], 
+                                       representations=representations)},
+        })
+
+        def call(accept):
+            request = falcon.Request(falcon_testing.create_environ(
+                path='/api/test', headers={'Accept': accept}))
+            return version_mapper(request, self.create_response())
+
+        response = call('application/vnd.myapi.v2+json')
+        self.assertEqual(response.content_type, 'application/json')
+        self.assertEqual(json.loads(response.data), dict(a=2))
+        response = call('application/vnd.myapi.v1+msgpack')
+        self.assertEqual(response.content_type, 'application/x-msgpack')
+        self.assertEqual(response.data, 'msgpack')
+        self.assertRaises(falcon.HTTPNotAcceptable, call, 
+                          'application/vnd.myapi.v2+xml')
+
+    def test_streamed_output(self):
+        stored = []
+        class MockCache(object):
+            def store_response(self, path, response, **kwargs):
+                stored.append(response.data)
+        class MockApp(object):
+            cache = MockCache()
+
+        def export(): 
+            for i in range(3):
+                yield dict(i=i)
+        request = falcon.Request(self.create_environ())
+
+        # not cached by default
+        wrapper = Wrapper(MockApp(), export, [], [], cacheable=True,
+                          output_stream=ndjson_output_stream)
+        response = self.create_response()
+        wrapper.execute(request, response, {})
+        self.assertIsNone(response.data)
+        self.assertEqual(response.content_type, 'application/x-ndjson')
+        lines = b''.join(response.stream).decode('utf8').splitlines()
+        self.assertEqual([json.loads(line) for line in lines], 
+                         [dict(i=0), dict(i=1), dict(i=2)])
+        self.assertEqual(stored, [])
+
+        # or stored once sent in full
+        wrapper = Wrapper(MockApp(), export, [], [], cacheable=True,
+                          output_stream=ndjson_output_stream, 
+                          stream_cache='tee')
+        response = self.create_response()
+        wrapper.execute(request, response, {})
+        self.assertEqual(stored, [])
+        body = b''.join(response.stream)
+        self.assertEqual(stored, [body])
+
+    def test_streamed_output_skips_cache(self):
+        class MockApp(object):
+            def populate_from_cache(self, request, response, **kwargs):
+                raise AssertionError('looked up')
+        def export():
+            yield dict(i=0)
+        wrapper = Wrapper(MockApp(), export, [], [], cacheable=True,
+                          single_flight=True, 
+                          output_stream=ndjson_output_stream)
+        response = self.create_response()
+        wrapper(falcon.Request(self.create_environ()), response)
+        self.assertEqual(json.loads(b''.join(response.stream).decode('utf8')),
+                         dict(i=0))
+
     def test_call(self):
         app = None 
         def abc(a, b, c, __user__, d=3, e=None): pass
@@ -1,71 +1,178 @@
 import inspect
+import logging
+import re
+import time
+from bisect import bisect_right
+from collections import namedtuple
 from datetime import datetime
 
+import falcon
+
 from ._compat import iteritems
 
 class FuncSpec(object):
-    def __init__(self, func):
+    def __init__(self, func, argspec=None):
         self.name = func.__name__
         self.module = func.__module__
-        info = inspect.getargspec(func)
-        self.defaults = info.defaults
-        self.allargs = info.args
-        self.args = info.args[:-len(info.defaults)] if info.defaults else []
-        self.kwargs = info.args[-len(info.defaults):] if info.defaults else []
-        self.kwargsdict = (dict(zip(info.args[-len(info.defaults):], 
-                                info.defaults)) 
-                            if info.defaults else {})
-        self.varargs = info.varargs
-        self.varkwargs = info.keywords
+        if argspec is None:
+            info = inspect.getargspec(func)
+            argspec = (info.args, info.varargs, info.keywords)
+        # (args, varargs, keywords), what a route cache can store and hand
+        # back to skip the introspection
+        self.argspec = argspec
+        allargs, varargs, varkwargs = argspec
+        defaults = func.__defaults__
+        self.defaults = defaults
+        self.allargs = allargs
+        self.args = allargs[:-len(defaults)] if defaults else []
+        self.kwargs = allargs[-len(defaults):] if defaults else []
+        self.kwargsdict = (dict(zip(allargs[-len(defaults):], defaults)) 
+                            if defaults else {})
+        self.varargs = varargs
+        self.varkwargs = varkwargs
 
 
 class VersionMapper(object):
-
-    def __init__(self, api_versioned_routes):
+    """
+    Dispatches a request to the version of an action it asks for. The version
+    can be requested in the url (`/v2/...`), in a vendor media type of the 
+    `Accept` header (`application/vnd.myapi.v2+json`), in the 
+    `version_header` header or in the `version_param` query string param. 
+    Any of these may be `latest`. Requests for a version that wasn't 
+    registered get the closest version below it, so that a route only needs 
+    registering again when it changes.
+    """
+
+    version_header = 'X-API-Version'
+    version_param = 'api_version'
+    media_type_pattern = r'vnd\.[^,;]*?\.v(?P<version>\d+|latest)\b'
+
+    def __init__(self, api_versioned_routes, version_header=None, 
+                 version_param=None, media_type_pattern=None):
+        if version_header is not None:
+            self.version_header = version_header
+        if version_param is not None:
+            self.version_param = version_param
+        self.media_type = re.compile(media_type_pattern 
+                                     or self.media_type_pattern)
         self.api_versioned_routes = api_versioned_routes
 
-    def get_route(self, request, url_version=None):
-        version = set([url_version]) if url_version else set()
-        # TODO get version from query string params
-        # TODO get version from request header
-        if len(version) > 1:
-            # TODO make this an HTTP error
-            raise Exception('Conflicting versions requested.')
+    @property
+    def api_versioned_routes(self):
+        return self._api_versioned_routes
+
+    @api_versioned_routes.setter
+    def api_versioned_routes(self, api_versioned_routes):
+        self._api_versioned_routes = api_versioned_routes
+        self.compile()
+
+    def compile(self):
+        """
+        Flattens the routes into a table of prepared handlers, so that a 
+        request usually only costs a dict lookup. The table is keyed by 
+        version, both as registered and as found in requests (i.e. strings),
+        with `latest` resolving to the latest version and `None` to the 
+        default one: the one registered without a number or else the latest.
+        Sorted version numbers back the lookup of unregistered versions.
+        """
+        self.handlers = handlers = {}
+        for version, route in iteritems(self.api_versioned_routes):
+            converters = tuple(iteritems(route.get('converters', None) or {}))
+            handlers[version] = (route, route['action_func'], converters)
+            if version is not None:
+                handlers[str(version)] = handlers[version]
+
+        self.versions = sorted(
+            v for v in self.api_versioned_routes if v is not None)
+        if self.versions:
+            handlers['latest'] = handlers[self.versions[-1]]
+            handlers.setdefault(None, handlers['latest'])
+        elif None in handlers:
+            handlers['latest'] = handlers[None]
+
+    def requested_version(self, request, url_version=None):
+        version = url_version or None
+        if self.version_header:
+            version = self._merge_versions(
+                version, request.get_header(self.version_header))
+        if self.version_param:
+            version = self._merge_versions(
+                version, request.get_param(self.version_param))
+        accept = request.get_header('Accept')
+        if accept and 'vnd.' in accept:
+            match = self.media_type.search(accept)
+            if match:
+                version = self._merge_versions(version, match.group('version'))
+        return version
+
+    def _merge_versions(self, version, other):
+        if other is None or other=='':
+            return version
+        if version is None or str(version)==other:
+            return other
+        raise falcon.HTTPBadRequest(
+            title='Bad Request', description='Conflicting versions requested.')
+
+    def get_handler(self, request, url_version=None):
+        version = self.requested_version(request, url_version=url_version)
+        try:
+            return self.handlers[version]
+        except KeyError:
+            pass
         try:
-            version = list(version)[0]
-        except IndexError:
-            version = None
-        # if a version is not specified it either means that
-        # - we want the version which did not specify a number
-        # - or we want the latest version
-        return self.api_versioned_routes.get(version, None)
+            version = int(version)
+        except (TypeError, ValueError):
+            return None
+        # the closest version below the requested one
+        position = bisect_right(self.versions, version)
+        if position:
+            return self.handlers[self.versions[position - 1]]
+
+    def get_route(self, request, url_version=None):
+        handler = self.get_handler(request, url_version=url_version)
+        return handler[0] if handler else None
 
     def get_action(self, request, params=None):
         url_version = (params.get('version', None) if params else
                        None)
         route = self.get_route(request, url_version=url_version)
+        if route is None:
+            raise falcon.HTTPNotFound()
         return route['action_func']
 
     def __call__(self, request, response, **params):
-        route = self.get_route(
+        handler = self.get_handler(
             request, url_version=params.pop('version', None))
-
-        if route is None:
-            #TODO: add a not found handler here 
-            pass
+        if handler is None:
+            raise falcon.HTTPNotFound()
+        route, action_func, converters = handler
 
         # converting param values to types specified during routing
-        if route.get('converters', None):
-            for name, converter in iteritems(route['converters']):
-                try:
+        try:
+            for name, converter in converters:
+                if name in params:
                     params[name] = converter(params[name])
-                except KeyError:
-                    pass
+        except ValueError:
+            # the url doesn't match any resource
+            raise falcon.HTTPNotFound()
 
         #response.body = route['action_func'](request, response, **params)
-        route['action_func'](request, response, **params)
+        action_func(request, response, **params)
         return response
 
+# the special arguments an action can expect, with how each is obtained
+INJECTORS = (
+    ('__app__', lambda wrapper, request, response: wrapper.app),
+    ('__request__', lambda wrapper, request, response: request),
+    ('__response__', lambda wrapper, request, response: response),
+    ('__data__', lambda wrapper, request, response: 
+        wrapper.read_data(request)),
+    ('__user__', lambda wrapper, request, response: 
+        request.context.get('user', None)),
+    ('__tenant__', lambda wrapper, request, response: 
+        request.context.get('tenant', None)),
+)
+
 """
 - positional arguments should come from the url
 - keyword arguments should come from parameters
@@ -73,14 +180,53 @@ class VersionMapper(object):
 - xkwargs arguments?
 """
 
+try:
+    HTTPPayloadTooLarge = falcon.HTTPPayloadTooLarge
+except AttributeError:
+    # falcon < 2.0
+    HTTPPayloadTooLarge = falcon.HTTPRequestEntityTooLarge
+
+class LimitedStream(object):
+    """
+    Reads at most `limit` bytes from `stream`, for bodies whose length isn't 
+    known in advance.
+    """
+    def __init__(self, stream, limit):
+        self.stream = stream
+        self.limit = limit
+        self.count = 0
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.limit - self.count + 1
+        else:
+            size = min(size, self.limit - self.count + 1)
+        rv = self.stream.read(size)
+        self.count += len(rv)
+        if self.count > self.limit:
+            raise HTTPPayloadTooLarge(
+                title='Payload too large', 
+                description='The body exceeds {0} bytes.'.format(self.limit))
+        return rv
+
+logger = logging.getLogger(__name__)
+
+# what a background revalidation keeps of the request it was triggered by
+RequestSnapshot = namedtuple('RequestSnapshot', 
+                             ['path', 'params', 'query_string', 'context'])
+
+# a vendor media type with a structured syntax suffix, e.g. 
+# `application/vnd.myapi.v2+json`, as used to request a version
+_vendor_media_type = re.compile(r'[\w.+-]+/vnd\.[^,;\s]*\+(?P<suffix>[\w.-]+)')
+
 class Wrapper(object):
 
     def __init__(self, app, func, input_formatters, output_formatters, 
-                 **kwargs):
+                 argspec=None, **kwargs):
 
         self.app = app
         self.func = func
-        self.func_specs = FuncSpec(func)
+        self.func_specs = FuncSpec(func, argspec=argspec)
         self.input_formatters = input_formatters
         self.output_formatters = output_formatters
 
@@ -89,6 +235,11 @@ class Wrapper(object):
             #expects_data=False, expects_params=False, expects_file=False, 
             #expects_user=False, expects_role=False, 
             cacheable=False, endpoint=None, #if_match=False, if_none_match=False,
+            single_flight=False, single_flight_timeout=10,
+            fresh_ttl=None, stale_ttl=None, early_expiration=None,
+            input_stream=None, max_body_size=None,
+            output_stream=None, stream_cache='skip',
+            representations=None,
             multitenant=False, tenants=[],
         )
 
@@ -99,6 +250,40 @@ class Wrapper(object):
             if ('__user__' in self.func_specs.allargs) or self.authorization
             else  False)
 
+        # what the action needs on each call, worked out once and for all
+        self.injectors = tuple((name, injector) for name, injector in INJECTORS
+                               if name in self.func_specs.allargs)
+        self.query_kwargs = frozenset(self.func_specs.kwargsdict)
+        # the request itself, and its body, are gone once it's answered
+        self.background_revalidation = not set(
+            ['__data__', '__request__']).intersection(self.func_specs.allargs)
+        # streams aren't stored unless teed, no use looking them up
+        self.uses_cache = self.cacheable and (
+            self.output_stream is None or self.stream_cache!='skip')
+
+        # (media type, output formatters) in order of preference, the first 
+        # one being served by default and cached under the plain key
+        self.media_types = []
+        self.variants = {None: self.output_formatters}
+        # suffix of vendor media types -> the representation they stand for
+        self.suffixes = {}
+        if self.representations:
+            if self.output_stream is not None:
+                # a stream has a single encoding, whatever was negotiated
+                raise ValueError('A route with an output_stream can\'t '
+                                 'have representations.')
+            self.media_types = [m for m, formatters in self.representations]
+            self.output_formatters = self.representations[0][1]
+            self.variants = dict(self.representations[1:])
+            self.variants[None] = self.output_formatters
+            for media_type in self.media_types:
+                # `application/hal+json` and `application/x-msgpack` would
+                # be `json` and `msgpack`
+                suffix = media_type.partition('/')[2].rpartition('+')[2]
+                if suffix.startswith('x-'):
+                    suffix = suffix[2:]
+                self.suffixes.setdefault(suffix, media_type)
+
     def __call__(self, request, response, **kwargs):
         api_version = kwargs.pop('version', None)
         tenant = kwargs.pop('tenant', None)
@@ -111,17 +296,20 @@ class Wrapper(object):
             #TODO: make it an HTTP error
             raise Exception('Unauthorized user.')
 
-        params = dict()
-        for arg, value in iteritems(kwargs):
-            params[arg] = value
+        variant = None
+        if self.media_types:
+            variant = self.negotiate(request, response)
 
-        for param, value in iteritems(request.params):
-            if param in self.func_specs.kwargsdict:
+        params = kwargs
+        if self.query_kwargs:
+            request_params = request.params
+            for param in self.query_kwargs:
                 # not overwriting params
-                params.setdefault(param, value)
+                if param in request_params and param not in params:
+                    params[param] = request_params[param]
 
         cached = False
-        if self.cacheable:
+        if self.uses_cache:
             # TODO: if the resource expects a role, fetch it from the user and
             # add it to the call here. 
             # The present wrapper should have an attribute to remember the 
@@ -129,41 +317,191 @@ class Wrapper(object):
             # to the user's currently assumed role (user.current_role) to
             # determine which representation of the resource should be
             # returned by either the cache or the api call.
-            cached = self.app.populate_from_cache(request, response)
+            cached = self.load_cached(request, response, variant)
 
         if cached:
-            return response
-
+            if not response.context.get('stale'):
+                return response
+            if self.background_revalidation:
+                self.revalidate(request, params, variant)
+                return response
+            # refreshed before answering instead
+            self.discard_cached(response)
+
+        self.inject(params, request, response)
+
+        if not (self.uses_cache and self.single_flight):
+            return self.execute(request, response, params, variant)
+
+        # only one request computes a missing response, concurrent ones wait
+        # for it to be stored and serve it from the cache
+        with self.app.cache.single_flight(
+            request.path, params=request.params, 
+            query_string=request.query_string, variant=variant,
+            timeout=self.single_flight_timeout) as leader:
+            if not leader and self.load_cached(request, response, variant):
+                return response
+            return self.execute(request, response, params, variant)
+
+    def negotiate(self, request, response):
+        # the representation asked for by `Accept`
+        accept = request.get_header('Accept')
+        if not accept or accept.strip()=='*/*':
+            # falcon versions break ties between equally acceptable types
+            # differently, the first declared is the default
+            media_type = self.media_types[0]
+        else:
+            media_types = self.media_types
+            vendor_types = {}
+            if 'vnd.' in accept:
+                # a vendor media type requesting a version, see 
+                # `VersionMapper`, is served the representation of its suffix
+                for match in _vendor_media_type.finditer(accept):
+                    if match.group('suffix') in self.suffixes:
+                        vendor_types[match.group(0)] = self.suffixes[
+                            match.group('suffix')]
+                media_types = self.media_types + list(vendor_types)
+            media_type = request.client_prefers(media_types)
+            media_type = vendor_types.get(media_type, media_type)
+        if media_type is None:
+            raise falcon.HTTPNotAcceptable(
+                description='Available media types: {0}.'
+                            .format(', '.join(self.media_types)))
+        response.content_type = media_type
+        response.append_header('Vary', 'Accept')
+        if media_type != self.media_types[0]:
+            return media_type
+
+    def discard_cached(self, response):
+        # undoes `populate_from_cache()`, the stale entry's encoding and
+        # validators don't describe the refreshed body
+        for name in ('Content-Encoding', 'ETag', 'Last-Modified', 'Vary'):
+            response.delete_header(name)
+        if self.media_types:
+            response.append_header('Vary', 'Accept')
+        response.status = falcon.HTTP_200
+        response.data = None
+        response.context.pop('stale', None)
+
+    def inject(self, params, request, response):
         # TODO
         # other potential objects of interest
-        # - data
         # - files
-
-        if '__app__' in self.func_specs.allargs:
-            params['__app__'] = self.app
-
-        if '__request__' in self.func_specs.allargs:
-            params['__request__'] = request
-
-        if '__response__' in self.func_specs.allargs:
-            params['__response__'] = response
-
-        if '__data__' in self.func_specs.allargs:
-            api_data = request.bounded_stream.read()
-            params['__data__'] = self.input_format(api_data)
-            
-        if '__user__' in self.func_specs.allargs:
-            params['__user__'] = request.context.get('user', None)
-
-        if '__tenant__' in self.func_specs.allargs:
-            params['__tenant__'] = request.context.get('tenant', None)
-
+        for name, injector in self.injectors:
+            params[name] = injector(self, request, response)
+        return params
+
+    def load_cached(self, request, response, variant=None):
+        return self.app.populate_from_cache(
+            request, response, fresh_ttl=self.fresh_ttl, 
+            stale_ttl=self.stale_ttl, beta=self.early_expiration, 
+            variant=variant)
+
+    def execute(self, request, response, params, variant=None):
+        if self.output_stream is not None:
+            return self.stream(request, response, params)
+
+        if not self.cacheable:
+            response.context['result'] = result = self.func(**params)
+            response.data = self.output_format(result, variant)
+            return
+
+        started = time.time()
         response.context['result'] = result = self.func(**params)
-        response.data = self.output_format(result)
-
-        if self.cacheable:
+        response.data = self.output_format(result, variant)
+        response.last_modified = datetime.utcnow()
+        self.cache_response(request, response, started, variant)
+
+    def cache_response(self, request, response, started, variant=None):
+        # stale entries are kept around until they can't be served
+        ttl = (self.fresh_ttl + (self.stale_ttl or 0)
+               if self.fresh_ttl is not None else None)
+        self.app.cache.store_response(
+            request.path, response, params=request.params, 
+            query_string=request.query_string, ttl=ttl, 
+            delta=time.time() - started, variant=variant)
+
+    def stream(self, request, response, params):
+        # the body is sent in chunks as the result is iterated, e.g. the 
+        # records of a generator, rather than encoded in one go
+        started = time.time()
+        response.context['result'] = None
+        media_type = getattr(self.output_stream, 'media_type', None)
+        if media_type:
+            response.content_type = media_type
+        chunks = self.output_stream(self.func(**params))
+        if self.cacheable and self.stream_cache == 'tee':
             response.last_modified = datetime.utcnow()
-            self.cache.store_response(request, response)
+            chunks = self.tee(chunks, request, response, started)
+        response.stream = chunks
+
+    def tee(self, chunks, request, response, started):
+        # the body is only stored once it has been sent in full
+        body = []
+        for chunk in chunks:
+            body.append(chunk)
+            yield chunk
+        response.data = b''.join(body)
+        self.cache_response(request, response, started)
+
+    def revalidate(self, request, params, variant=None):
+        # refreshing a stale response in the background, once at a time
+        key = self.app.cache.make_key(
+            request.path, params=request.params, 
+            query_string=request.query_string, variant=variant)
+        with self.app.revalidations_lock:
+            if key in self.app.revalidations:
+                return
+            self.app.revalidations.add(key)
+        snapshot = RequestSnapshot(request.path, dict(request.params), 
+                                   request.query_string, request.context)
+        self.app.background.apply_async(
+            self._revalidate, (key, snapshot, params, variant))
+
+    def _revalidate(self, key, request, params, variant=None):
+        try:
+            response = falcon.Response()
+            self.execute(request, response, 
+                         self.inject(dict(params), request, response), 
+                         variant)
+            if response.stream is not None:
+                # a teed stream is stored as it's consumed
+                for chunk in response.stream:
+                    pass
+        except Exception:
+            logger.exception("Revalidating '%s' failed.", key)
+        finally:
+            with self.app.revalidations_lock:
+                self.app.revalidations.discard(key)
+            # as done by `GlobalsMiddleWare` at the end of a request
+            if getattr(self.app, 'db', None) is not None:
+                self.app.db.Session.remove()
+
+    def read_data(self, request):
+        limit = self.max_body_size
+        stream = request.bounded_stream
+        if limit is not None:
+            if (request.content_length or 0) > limit:
+                raise HTTPPayloadTooLarge(
+                    title='Payload too large', 
+                    description='The body exceeds {0} bytes.'.format(limit))
+            stream = LimitedStream(stream, limit)
+
+        if self.input_stream is None:
+            return self.input_format(stream.read())
+        # records are handed to the action as it asks for them
+        return self.iter_data(self.input_stream(stream))
+
+    def iter_data(self, records):
+        while True:
+            try:
+                record = next(records)
+            except StopIteration:
+                return
+            except ValueError as e:
+                raise falcon.HTTPBadRequest(title='Invalid body', 
+                                            description=str(e))
+            yield record
 
     def input_format(self, input):
         rv = input
@@ -171,8 +509,8 @@ class Wrapper(object):
             rv = f(rv)
         return rv
 
-    def output_format(self, output):
+    def output_format(self, output, variant=None):
         rv = output
-        for f in self.output_formatters:
+        for f in self.variants[variant]:
             rv = f(rv)
         return rv